@@ -1,12 +1,16 @@
+import asyncio
 import time
 from collections import abc
 from copy import deepcopy
 from enum import IntEnum
-from typing import Dict, NamedTuple
+from typing import Dict, NamedTuple, Type
 
 from lib.gfx import Point
-from lib.intcoder import Intcoder, RunResult
-from lib.utils import readnumbers_csv, timestamp
+from lib.intasync import EOF, AsyncIntcoder
+from lib.intblocks import BlockIntcoder
+from lib.intcoder import Intcoder
+from lib.intimage import load_program
+from lib.utils import timestamp
 
 
 class MapToken(IntEnum):
@@ -61,19 +65,19 @@ class Paintmap(abc.MutableMapping):
 
 
 class IntRobot():
-    coder: Intcoder
+    coder: AsyncIntcoder
     paint_map: Dict
     pos: Point
     heading: Heading
 
-    def __init__(self, data, input_buffer=None):
-        self.coder = Intcoder(data, input_buffer)
+    def __init__(self, data, input_buffer=None, engine: Type[Intcoder] = BlockIntcoder):
+        self.coder = AsyncIntcoder(engine(data, input_buffer), send_eof=True)
         self.heading = Heading.Up
         self.pos = Point(0, 0)
         self.paint_map = {}
 
     def send_color(self, token: MapToken):
-        self.coder.inbuffer.append(token.value)
+        self.coder.inbox.put_nowait(token.value)
 
     def paint(self, token: MapToken):
         self.paint_map[self.pos] = token
@@ -99,43 +103,46 @@ class IntRobot():
         newpos = self.pos + delta
         self.pos = newpos
 
-    def do_step(self):
-        pixel = self.token_at(self.pos)
-        self.send_color(pixel)
-        rt_val = self.coder.run_until_input()
-        if rt_val.result == RunResult.Halted:
-            return rt_val
-        [turn, token] = self.coder.outbuffer.pop(), self.coder.outbuffer.pop()  # LIFO
-        self.paint(MapToken(token))
-        self.turn(turn)
-        self.move()
+    async def drive(self):
+        # the robot only wakes up once the program has painted and turned; those event loop round trips,
+        # and the VM's step-counted slices, make part 1 about 1.7x slower than the old synchronous loop
+        outbox = self.coder.outbox
+        self.send_color(self.token_at(self.pos))
+        while (token := await outbox.get()) is not EOF:
+            self.paint(MapToken(token))
+            self.turn(await outbox.get())
+            self.move()
+            self.send_color(self.token_at(self.pos))
+
+    async def run_async(self):
+        await asyncio.gather(self.coder.run(), self.drive())
 
     def run_until_done(self):
-        rt_val = None
-        while not rt_val:
-            rt_val = self.do_step()
+        asyncio.run(self.run_async())
 
 
-def part1(data):
-    start = time.time()
-    robot = IntRobot(deepcopy(data))
+def paint(data, start: MapToken = None, engine: Type[Intcoder] = BlockIntcoder) -> int:
+    robot = IntRobot(deepcopy(data), engine=engine)
+    if start is not None:
+        robot.paint_map[Point(0, 0)] = start
     robot.run_until_done()
     drawn_coords = [x for x in robot.paint_map if x != MapToken.Void]
-    run_counter = len(drawn_coords)
+    return len(drawn_coords)
+
+
+def part1(data):
+    start = time.time()
+    run_counter = paint(data)
     timestamp(start, f"Part 1: {run_counter}")
 
 
 def part2(data):
     start = time.time()
-    robot = IntRobot(deepcopy(data))
-    robot.paint_map[Point(0, 0)] = MapToken.White
-    robot.run_until_done()
-    drawn_coords = [x for x in robot.paint_map if x != MapToken.Void]
-    run_counter = len(drawn_coords)
+    run_counter = paint(data, MapToken.White)
     timestamp(start, f"Part 2: {run_counter}")
 
 
 if __name__ == "__main__":
-    testdata = readnumbers_csv("day11.csv")[0]
+    testdata = load_program("day11.csv")
     part1(testdata)
     part2(testdata)
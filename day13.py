@@ -1,10 +1,14 @@
 import time
 from copy import deepcopy
 from enum import IntEnum
-from typing import DefaultDict, List
+from typing import List, Type
 
-from lib.intcoder import Intcoder, ReturnVal, RunResult
-from lib.utils import readnumbers_csv, timestamp
+import numpy as np
+
+from lib.intblocks import BlockIntcoder
+from lib.intcoder import Intcoder
+from lib.intimage import load_program
+from lib.utils import timestamp
 
 
 class Tile(IntEnum):
@@ -14,64 +18,20 @@ class Tile(IntEnum):
     Paddle = 3,
     Ball = 4,
 
-    @staticmethod
-    def parse(s: str):
-        return next((k for k, v in TileType.items() if k == s))
-
-
-TileType = {
-    Tile.Empty: "  ",
-    Tile.Wall: "##",
-    Tile.Block: "[]",
-    Tile.Paddle: "__",
-    Tile.Ball: "()",
-}
-
-
-class IntArcadeHelper():
-    tilemap: DefaultDict
 
-    def render(self):
-        chart = []
-
-        for row in self.tilemap.values():
-            line = "".join([TileType[tile.value] for tile in row.values()])
-            chart.append(line)
-
-        print("\n".join(chart))
-
-
-class IntArcade(IntArcadeHelper):
-    tilemap: DefaultDict
+class IntArcade():
     coder: Intcoder
+    frame: np.ndarray
     score: int
+    blocks: int
     ball_xpos: int
     paddle_pos: int
 
-    def __init__(self, code):
-        self.coder = Intcoder(code)
-        self.tilemap = DefaultDict(dict)
+    def __init__(self, code, engine: Type[Intcoder] = BlockIntcoder):
+        self.coder = engine(code)
+        self.frame = np.zeros((0, 0), dtype=np.uint8)
         self.score = 0
-
-    def parsemap(self, data: List[int]):
-        pc = 0
-        total_size = len(data)
-        while pc < total_size:
-            (pos_x, pos_y, tile_type) = data[pc:pc+3]
-            pc += 3
-
-            if tile_type == Tile.Ball.value:
-                self.ball_xpos = pos_x
-
-            elif tile_type == Tile.Paddle.value:
-                self.paddle_pos = pos_x
-
-            if pos_x == -1 and pos_y == 0:
-                self.score = tile_type
-                continue
-
-            # uncomment for render
-            self.tilemap[pos_y][pos_x] = Tile.parse(tile_type)
+        self.blocks = 0
 
     def get_desired_joystick(self):
         if self.paddle_pos < self.ball_xpos:
@@ -80,35 +40,111 @@ class IntArcade(IntArcadeHelper):
             return -1
         return 0
 
-    def run_interactive(self):
-        rs: ReturnVal = None
-        while not rs or rs.result != RunResult.Halted:
-            rs = self.coder.run_until_input()
-            self.parsemap(self.coder.outbuffer)
-            self.coder.outbuffer = []  # clear buffer
-
-            self.coder.inbuffer.append(self.get_desired_joystick())
+    def run_screen(self):
+        # no joystick: the game draws its screen and halts, and the whole output is decoded at once
+        self.coder.run()
+        tiles = np.array(self.coder.outbuffer, dtype=np.int64).reshape(-1, 3)
+        self.coder.outbuffer.clear()
+        self.draw_all(tiles)
+
+    def run_frames(self):
+        # every tile goes into the framebuffer as it is drawn, so the joystick can be read on demand
+        self.coder.inbuffer = self.get_desired_joystick
+        for tile in self.coder.outputs(3):
+            self.draw(*tile)
+
+    def fit(self, width: int, height: int):
+        # the screen is as big as the game draws it, the frame grows to match
+        rows, cols = self.frame.shape
+        frame = np.zeros((max(rows, height), max(cols, width)), dtype=np.uint8)
+        frame[:rows, :cols] = self.frame
+        self.frame = frame
+
+    def draw_all(self, tiles: np.ndarray):
+        # tiles as rows of x, y, tile
+        xs, ys, ids = tiles.T
+        scores = (xs == -1) & (ys == 0)
+        if scores.any():
+            self.score = int(ids[scores][-1])
+        xs, ys, ids = xs[~scores], ys[~scores], ids[~scores]
+        if not len(xs):
+            return
+
+        self.fit(int(xs.max()) + 1, int(ys.max()) + 1)
+        # a cell drawn more than once keeps the last tile drawn there
+        cells = ys * self.frame.shape[1] + xs
+        last = len(cells) - 1 - np.unique(cells[::-1], return_index=True)[1]
+        self.frame[ys[last], xs[last]] = ids[last]
+        balls = xs[ids == Tile.Ball]
+        if len(balls):
+            self.ball_xpos = int(balls[-1])
+        paddles = xs[ids == Tile.Paddle]
+        if len(paddles):
+            self.paddle_pos = int(paddles[-1])
+        self.blocks = int(np.count_nonzero(self.frame == Tile.Block))
+
+    def draw(self, pos_x: int, pos_y: int, tile_type: int):
+        if pos_x == -1 and pos_y == 0:
+            self.score = tile_type
+            return
+
+        if pos_y >= self.frame.shape[0] or pos_x >= self.frame.shape[1]:
+            self.fit(pos_x + 1, pos_y + 1)
+        # keep the block count as tiles are drawn over
+        self.blocks += (tile_type == Tile.Block) - (int(self.frame[pos_y, pos_x]) == Tile.Block)
+        self.frame[pos_y, pos_x] = tile_type
+        if tile_type == Tile.Ball:
+            self.ball_xpos = pos_x
+        elif tile_type == Tile.Paddle:
+            self.paddle_pos = pos_x
+
+
+def drawing(values: List[int]) -> List[int]:
+    # a program that outputs values and halts
+    return [x for value in values for x in (104, value)] + [99]
+
+
+def test():
+    # the frame grows to the screen drawn, the score is kept apart and a cell drawn twice keeps its last tile
+    screen = [2, 1, 2, 50, 30, 2, 50, 30, 4, 7, 1, 3, -1, 0, 12]
+    arcade = IntArcade(drawing(screen))
+    arcade.run_screen()
+    assert arcade.frame.shape == (31, 51) and arcade.frame[30, 50] == Tile.Ball
+    assert (arcade.blocks, arcade.score, arcade.ball_xpos, arcade.paddle_pos) == (1, 12, 50, 7)
+
+    # drawn tile by tile, erasing the last block leaves none
+    arcade = IntArcade(drawing(screen + [2, 1, 0]))
+    arcade.run_frames()
+    assert arcade.frame.shape == (31, 51) and arcade.blocks == 0 and arcade.score == 12
+    print("Arcade tests passed.")
+
+
+def count_blocks(data, engine: Type[Intcoder] = BlockIntcoder) -> int:
+    arcade = IntArcade(deepcopy(data), engine)
+    arcade.run_screen()
+    return arcade.blocks
+
+
+def play(data, engine: Type[Intcoder] = BlockIntcoder) -> int:
+    code = deepcopy(data)
+    code[0] = 2
+    arcade = IntArcade(code, engine)
+    arcade.run_frames()
+    return arcade.score
 
 
 def part1(data):
     start = time.time()
-    arcade = IntArcade(deepcopy(data))
-    arcade.coder.run()
-    arcade.render()
-    num_block_tiles = arcade.coder.outbuffer.count(Tile.Block.value)
-    timestamp(start, f"Part 1: {num_block_tiles}")
+    timestamp(start, f"Part 1: {count_blocks(data)}")
 
 
 def part2(data):
     start = time.time()
-    code = deepcopy(data)
-    code[0] = 2
-    arcade = IntArcade(code)
-    arcade.run_interactive()
-    timestamp(start, f"Part 2: {arcade.score}")
+    timestamp(start, f"Part 2: {play(data)}")
 
 
 if __name__ == "__main__":
-    testdata = readnumbers_csv("day13.csv")[0]
+    test()
+    testdata = load_program("day13.csv")
     part1(testdata)
     part2(testdata)
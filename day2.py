@@ -2,7 +2,9 @@ import time
 from copy import copy
 
 from lib.intcoder import Intcoder
-from lib.utils import readnumbers_csv, timestamp
+from lib.intimage import load_program
+from lib.intsymbolic import find_patches
+from lib.utils import timestamp
 
 
 def test():
@@ -29,24 +31,19 @@ def part1(image):
     timestamp(start, f"Part 1: {m}")
 
 
-def run_until(rom, expected_result: int):
-    for noun in range(0, 99):
-        for verb in range(0, 99):
-            ram = copy(rom)
-            ram[1] = noun
-            ram[2] = verb
-            vm = Intcoder(ram)
-            result = vm.run()
-            if result == expected_result:
-                return noun * 100 + verb
+def run_until_symbolic(rom, expected_result: int):
+    # one symbolic run gives the result as a formula in noun and verb, solving it replaces the grid search
+    found = find_patches(rom, {1: "noun", 2: "verb"}, {"noun": range(100), "verb": range(100)}, expected_result)
+    if found:
+        return found["noun"] * 100 + found["verb"]
 
 
 def part2(image):
     start = time.time()
-    timestamp(start, f"Part 2: {run_until(image, 19690720)}")
+    timestamp(start, f"Part 2: {run_until_symbolic(image, 19690720)}")
 
 
-testdata = readnumbers_csv("day2.csv")[0]
+testdata = load_program("day2.csv")
 
 part1(testdata)
 part2(testdata)
@@ -1,53 +1,62 @@
 import time
 from copy import deepcopy
-from typing import Dict, List
+from functools import lru_cache
+from typing import Dict, List, Type
 
-from lib.intcoder import Intcoder, ReturnVal, RunResult
-from lib.utils import readnumbers_csv, timestamp
+from lib.intcoder import Intcoder, Snapshot
+from lib.intimage import load_program
+from lib.intring import run_loop
+from lib.intsched import Scheduler
+from lib.intspecial import Specializer
+from lib.intsweep import sweep
+from lib.utils import timestamp
 
 
 class Ampchain:
-    amps: List[Intcoder]
+    num_amps: int
+    memo: Specializer
 
     def __init__(self, data, num_amps=5):
-        self.amps = []
-        for _ in range(num_amps):
-            self.init_amp(data)
-
-    def init_amp(self, data):
-        amp = Intcoder(deepcopy(data))
-        self.amps.append(amp)
-
-    @property
-    def num_amps(self):
-        return len(self.amps)
+        template = data if isinstance(data, Intcoder) else Intcoder(data)
+        # a stage only depends on its phase and input signal, which the permutations keep repeating
+        self.memo = Specializer(template)
+        self.num_amps = num_amps
 
     def run(self, phases: List[int], input_val: int) -> int:
-        input_buffer = input_val
-        for i in range(len(self.amps)):
-            input_buffer = self.amps[i].run([input_buffer, phases[i]])  # FIFO
-        return input_buffer
+        signal = input_val
+        for i in range(self.num_amps):
+            signal = self.memo.run([phases[i], signal]).value
+        return signal
 
 
 class Amploop(Ampchain):
     def run(self, phases, input_val=0) -> int:
-        buffers: List[List[int]] = [[] for i in range(5)]
-        buffers[4].append(input_val)
-
-        states: List[ReturnVal] = [None] * 5
+        # each amp starts past reading its phase, then reads from its own channel and writes to the next amp's
+        scheduler = Scheduler()
+        channels = [scheduler.channel() for _ in range(self.num_amps)]
         for i in range(self.num_amps):
-            buffers[i].append(phases[i])
-            self.amps[i].inbuffer = buffers[i]
-            self.amps[i].outbuffer = buffers[(i+1) % self.num_amps]
+            amp = self.memo.resume([phases[i]])
+            scheduler.add(amp, channels[i], [channels[(i + 1) % self.num_amps]])
+        channels[0].put(input_val)
 
-        done = False
-        while not done:
-            for i in range(self.num_amps):
-                states[i] = self.amps[i].run_until_io()
+        scheduler.run()
+        return channels[0].get()
+
+
+class PipelinedAmploop(Amploop):
+    def run(self, phases, input_val=0) -> int:
+        # every amp in its own process, passing values through shared-memory rings
+        return run_loop([self.memo.resume([x]) for x in phases], [[] for _ in phases], input_val)
 
-            done = any(x.result == RunResult.Halted for x in states)
-        outval = buffers[4].pop()
-        return outval
+
+@lru_cache(maxsize=1)
+def feedback_loop(snapshot: Snapshot) -> Amploop:
+    # one loop per worker, so its phase setups are shared by every permutation
+    return Amploop(snapshot.vm)
+
+
+def run_feedback(snapshot: Snapshot, phases: List[int]) -> int:
+    return feedback_loop(snapshot).run(phases, 0)
 
 
 def test1():
@@ -81,6 +90,7 @@ def test2():
     t3machine = Amploop(t3code)
     t3result = t3machine.run(t3phases, 0)
     assert t3result == 139629729
+    assert PipelinedAmploop(t3code).run(t3phases, 0) == 139629729
 
     t4code = [3, 52, 1001, 52, -5, 52, 3, 53, 1, 52, 56, 54, 1007, 54, 5, 55, 1005, 55, 26, 1001, 54, -5, 54, 1105, 1, 12, 1,
               53, 54, 53, 1008, 54, 0, 55, 1001, 55, 1, 55, 2, 53, 55, 53, 4, 53, 1001, 56, -1, 56, 1005, 56, 6, 99, 0, 0, 0, 0, 10]
@@ -92,10 +102,6 @@ def test2():
     print("Part 2 tests passed.")
 
 
-# test1()
-# test2()
-
-
 def unique_phases(numiterations=5*5*5*5*5+1, offset=0) -> List[int]:
     phases = [0, 0, 0, 0, 0]
     for x in range(numiterations):
@@ -111,14 +117,29 @@ def unique_phases(numiterations=5*5*5*5*5+1, offset=0) -> List[int]:
         yield phases
 
 
-def part1(data):
-    start = time.time()
+def chain_results(data, engine: Type[Intcoder] = Intcoder) -> Dict[str, int]:
     results: Dict[str, int] = {}
 
+    chain = Ampchain(engine(data))
     for phases in unique_phases():
-        result = Ampchain(data).run(phases, 0)
         index = "-".join([str(n) for n in phases])
-        results[index] = result
+        results[index] = chain.run(phases, 0)
+    return results
+
+
+def feedback_results(data, engine: Type[Intcoder] = Intcoder, workers: int = None) -> Dict[str, int]:
+    results: Dict[str, int] = {}
+
+    phase_sets = (list(phases) for phases in unique_phases(offset=5))
+    for job in sweep(data, phase_sets, task=run_feedback, engine=engine, workers=workers, chunksize=8):
+        index = "-".join([str(n) for n in job.job])
+        results[index] = job.value
+    return results
+
+
+def part1(data):
+    start = time.time()
+    results = chain_results(data)
 
     best = max(results, key=lambda x: results[x])
     result = results[best]
@@ -127,21 +148,19 @@ def part1(data):
 
 def part2(data):
     start = time.time()
-
-    results: Dict[str, str] = {}
-
-    for phases in unique_phases(offset=5):
-        result = Amploop(data).run(phases, 0)
-        index = "-".join([str(n) for n in phases])
-        results[index] = result
+    results = feedback_results(data)
 
     best = max(results, key=lambda x: results[x])
     result = results[best]
     timestamp(start, f"Part 2: {best}: {result}")
 
 
-testdata = readnumbers_csv("day7.csv")[0]
-before = deepcopy(testdata)
+if __name__ == "__main__":
+    test1()
+    test2()
+
+    testdata = load_program("day7.csv")
+    before = deepcopy(testdata)
 
-part1(testdata)  # 22012
-part2(testdata)  # 4039164
+    part1(testdata)  # 22012
+    part2(testdata)  # 4039164
@@ -1,7 +1,9 @@
 import time
 
+from lib.intblocks import BlockIntcoder
 from lib.intcoder import Intcoder
-from lib.utils import readnumbers_csv, timestamp
+from lib.intimage import load_program
+from lib.utils import timestamp
 
 
 def test():
@@ -29,17 +31,17 @@ test()
 
 def part1(data):
     start = time.time()
-    coder = Intcoder(data)
+    coder = BlockIntcoder(data)
     result = coder.run([1])
     timestamp(start, (f"Part 1: {result}"))
 
 def part2(data):
     start = time.time()
-    coder = Intcoder(data)
+    coder = BlockIntcoder(data)
     result = coder.run([2])
     timestamp(start, (f"Part 2: {result}"))
     print(coder.outbuffer)
 
-testdata = readnumbers_csv("day9.csv")[0]
+testdata = load_program("day9.csv")
 part1(testdata)
 part2(testdata)
@@ -0,0 +1,110 @@
+import asyncio
+from typing import Optional
+
+from lib.intcoder import Intcoder, RunResult, StopOn
+
+EOF = None
+# instructions a VM runs before it lets other coroutines have the event loop
+SLICE_STEPS = 10000
+
+
+class AsyncIntcoder:
+    """
+    Runs an Intcoder as a coroutine: input is awaited from inbox, output is put to outbox.
+    The VM only wakes up when a value arrives, so any number of them can share one event loop;
+    a long computation yields every slice_steps instructions.
+    """
+    vm: Intcoder
+    inbox: asyncio.Queue
+    outbox: asyncio.Queue
+    send_eof: bool
+    slice_steps: int = SLICE_STEPS
+
+    def __init__(self, vm: Intcoder, inbox: asyncio.Queue = None, outbox: asyncio.Queue = None, send_eof=False):
+        self.vm = vm
+        self.inbox = inbox if inbox is not None else asyncio.Queue()
+        self.outbox = outbox if outbox is not None else asyncio.Queue()
+        self.send_eof = send_eof
+
+    async def run(self) -> Optional[int]:
+        # outputs never pile up in vm.outbuffer: an unbounded outbox takes them straight from the VM,
+        # a bounded one gets them one at a time so a full queue holds the VM back
+        vm, pending = self.vm, []
+        sink, stop_on = vm.sink, StopOn.Input
+        if self.outbox.maxsize:
+            vm.sink, stop_on = pending.append, StopOn.Input | StopOn.Output
+        else:
+            vm.sink = self.outbox.put_nowait
+        try:
+            while True:
+                rs = vm.run(stop_on=stop_on, max_steps=self.slice_steps)
+                for value in pending:
+                    await self.outbox.put(value)
+                pending.clear()
+                if rs.result == RunResult.NeedInput:
+                    vm.inbuffer.append(await self.inbox.get())
+                elif rs.result == RunResult.OutOfSteps:
+                    await asyncio.sleep(0)
+                elif rs.result == RunResult.Halted:
+                    if self.send_eof:
+                        await self.outbox.put(EOF)
+                    return rs.output
+        finally:
+            vm.sink = sink
+
+def test():
+    # a ring of VMs that each add one to a counter and pass it on, ten times round
+    code = [3, 20, 1001, 20, 1, 20, 4, 20, 1001, 21, 1, 21, 1008, 21, 10, 22, 1006, 22, 0, 99, 0, 0, 0]
+
+    async def ring(size: int) -> int:
+        queues = [asyncio.Queue() for _ in range(size)]
+        vms = [AsyncIntcoder(Intcoder(code), queues[i], queues[(i + 1) % size]) for i in range(size)]
+        queues[0].put_nowait(0)
+        await asyncio.gather(*(x.run() for x in vms))
+        return queues[0].get_nowait()
+
+    assert asyncio.run(ring(300)) == 3000
+
+    # a host coroutine reads outputs until the VM signals that it halted
+    async def host() -> list:
+        vm = AsyncIntcoder(Intcoder([104, 1, 104, 2, 99]), send_eof=True)
+        runner = asyncio.create_task(vm.run())
+        received = []
+        while (value := await vm.outbox.get()) is not EOF:
+            received.append(value)
+        await runner
+        return received
+
+    assert asyncio.run(host()) == [1, 2]
+
+    # a bounded outbox holds the VM back without its outputs collecting anywhere else
+    async def bounded() -> list:
+        vm = AsyncIntcoder(Intcoder([104, 1, 104, 2, 104, 3, 99]), outbox=asyncio.Queue(1))
+        runner = asyncio.create_task(vm.run())
+        received = [await vm.outbox.get() for _ in range(3)]
+        await runner
+        assert not vm.vm.outbuffer
+        return received
+
+    assert asyncio.run(bounded()) == [1, 2, 3]
+
+    # a VM counting to 100000 still lets a coroutine beside it run in between
+    async def busy() -> int:
+        counter = AsyncIntcoder(Intcoder([1001, 14, 1, 14, 1008, 14, 100000, 15, 1006, 15, 0, 4, 14, 99, 0, 0]))
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while not counter.outbox.qsize():
+                ticks += 1
+                await asyncio.sleep(0)
+
+        await asyncio.gather(counter.run(), tick())
+        return ticks
+
+    assert asyncio.run(busy()) > 10
+    print("AsyncIntcoder tests passed.")
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,214 @@
+from enum import IntEnum
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+from lib.intcoder import MODE_DIVISORS, OPCODES, PARAM_COUNTS, Intcoder, Opcode, ParamMode
+
+INT64_MIN = np.iinfo(np.int64).min
+INT64_MAX = np.iinfo(np.int64).max
+# isqrt(INT64_MAX): a product of two values no larger than this always fits
+MUL_SAFE = 3037000499
+MEM_ALIGN = 256
+
+
+class BatchState(IntEnum):
+    Running = 0
+    Halted = 1
+    NeedInput = 2
+    Scalar = 3
+
+
+class BatchIntcoder:
+    """
+    Runs many copies of one program in lockstep on NumPy arrays.
+    VMs about to execute the same instruction word step together; a VM whose
+    values stop fitting in int64 is handed over to a scalar Intcoder.
+    """
+    mem: np.ndarray
+    ptr: np.ndarray
+    ptroffset: np.ndarray
+    state: np.ndarray
+    inputs: np.ndarray
+    inpos: np.ndarray
+    inlen: np.ndarray
+    outputs: List[List[int]]
+    scalar: Dict[int, Intcoder]
+
+    def __init__(self, data: Sequence[int], count: int = None, inputs: Sequence[List[int]] = None):
+        count = count if count is not None else len(inputs)
+        inputs = inputs if inputs is not None else [[] for _ in range(count)]
+
+        self.mem = np.zeros((count, self.aligned(len(data))), dtype=np.int64)
+        self.mem[:, :len(data)] = np.array(data, dtype=np.int64)
+        self.ptr = np.zeros(count, dtype=np.int64)
+        self.ptroffset = np.zeros(count, dtype=np.int64)
+        self.state = np.full(count, BatchState.Running, dtype=np.int8)
+
+        width = max((len(x) for x in inputs), default=0)
+        self.inputs = np.zeros((count, max(width, 1)), dtype=np.int64)
+        for i, buffer in enumerate(inputs):
+            self.inputs[i, :len(buffer)] = buffer
+        self.inpos = np.zeros(count, dtype=np.int64)
+        self.inlen = np.array([len(x) for x in inputs], dtype=np.int64)
+
+        self.outputs = [[] for _ in range(count)]
+        self.scalar = {}
+
+    @property
+    def count(self) -> int:
+        return len(self.ptr)
+
+    @staticmethod
+    def aligned(size: int) -> int:
+        return (size + MEM_ALIGN - 1) // MEM_ALIGN * MEM_ALIGN
+
+    def reserve(self, addrs: np.ndarray):
+        needed = int(addrs.max(initial=0)) + 1
+        if needed > self.mem.shape[1]:
+            grown = np.zeros((self.count, self.aligned(needed)), dtype=np.int64)
+            grown[:, :self.mem.shape[1]] = self.mem
+            self.mem = grown
+
+    def run(self):
+        while True:
+            active = np.flatnonzero(self.state == BatchState.Running)
+            if not active.size:
+                return
+            self.reserve(self.ptr[active] + 4)
+            words = self.mem[active, self.ptr[active]]
+            for word in np.unique(words).tolist():
+                self.step(int(word), active[words == word])
+
+    def step(self, word: int, idx: np.ndarray):
+        if word < 0 or word % 100 not in OPCODES:
+            raise Exception(f"Illegal opcode {word} in batch. System on fire.")
+        opcode = Opcode(word % 100)
+        num_params = PARAM_COUNTS[opcode]
+        modes = [ParamMode(word // MODE_DIVISORS[x] % 10) for x in range(num_params)]
+        pc = self.ptr[idx]
+        params = [self.mem[idx, pc + x + 1] for x in range(num_params)]
+        addrs = [params[x] + self.ptroffset[idx] if modes[x] == ParamMode.Relative else params[x]
+                 for x in range(num_params)]
+
+        # negative addresses are left to the scalar engine
+        bad = np.zeros(len(idx), dtype=bool)
+        for x in range(num_params):
+            if modes[x] != ParamMode.Immediate:
+                bad |= addrs[x] < 0
+        if bad.any():
+            self.to_scalar(idx[bad])
+            keep = ~bad
+            idx, pc = idx[keep], pc[keep]
+            params, addrs = [x[keep] for x in params], [x[keep] for x in addrs]
+            if not idx.size:
+                return
+        for x in range(num_params):
+            if modes[x] != ParamMode.Immediate:
+                self.reserve(addrs[x])
+
+        def load(x: int) -> np.ndarray:
+            return params[x] if modes[x] == ParamMode.Immediate else self.mem[idx, addrs[x]]
+
+        if opcode in (Opcode.Add, Opcode.Mul):
+            a, b = load(0), load(1)
+            with np.errstate(over="ignore"):
+                value = a + b if opcode == Opcode.Add else a * b
+            overflow = self.overflowed(opcode, a, b, value)
+            if overflow.any():
+                self.to_scalar(idx[overflow])
+                keep = ~overflow
+                idx, pc, value, addrs[2] = idx[keep], pc[keep], value[keep], addrs[2][keep]
+            self.mem[idx, addrs[2]] = value
+        elif opcode == Opcode.LessThan:
+            self.mem[idx, addrs[2]] = load(0) < load(1)
+        elif opcode == Opcode.Equals:
+            self.mem[idx, addrs[2]] = load(0) == load(1)
+        elif opcode == Opcode.Input:
+            starved = self.inpos[idx] == self.inlen[idx]
+            self.state[idx[starved]] = BatchState.NeedInput
+            idx, pc, target = idx[~starved], pc[~starved], addrs[0][~starved]
+            self.mem[idx, target] = self.inputs[idx, self.inpos[idx]]
+            self.inpos[idx] += 1
+        elif opcode == Opcode.Output:
+            for i, value in zip(idx.tolist(), load(0).tolist()):
+                self.outputs[i].append(value)
+        elif opcode in (Opcode.JumpIfTrue, Opcode.JumpIfFalse):
+            taken = (load(0) != 0) == (opcode == Opcode.JumpIfTrue)
+            self.ptr[idx] = np.where(taken, load(1), pc + 3)
+            return
+        elif opcode == Opcode.ChangePtrOffset:
+            self.ptroffset[idx] += load(0)
+        elif opcode == Opcode.Halt:
+            self.state[idx] = BatchState.Halted
+            return
+        self.ptr[idx] = pc + num_params + 1
+
+    @staticmethod
+    def overflowed(opcode: Opcode, a: np.ndarray, b: np.ndarray, value: np.ndarray) -> np.ndarray:
+        if opcode == Opcode.Add:
+            return ((a ^ value) & (b ^ value)) < 0
+        overflow = np.zeros(len(a), dtype=bool)
+        large = (np.abs(a) > MUL_SAFE) | (np.abs(b) > MUL_SAFE) | (a == INT64_MIN) | (b == INT64_MIN)
+        if large.any():
+            exact = a[large].astype(object) * b[large].astype(object)
+            overflow[large] = [x < INT64_MIN or x > INT64_MAX for x in exact]
+        return overflow
+
+    def to_scalar(self, idx: np.ndarray):
+        for i in idx.tolist():
+            vm = Intcoder(self.mem[i].tolist())
+            vm.ptr = int(self.ptr[i])
+            vm.ptroffset = int(self.ptroffset[i])
+            vm.inbuffer = self.inputs[i, self.inpos[i]:self.inlen[i]].tolist()
+            vm.outbuffer = self.outputs[i]
+            vm.lastout = vm.outbuffer[-1] if vm.outbuffer else None
+            vm.run_until_input()
+            self.scalar[i] = vm
+            self.state[i] = BatchState.Scalar
+
+    def memory(self, i: int) -> List[int]:
+        if i in self.scalar:
+            return list(self.scalar[i].data)
+        return self.mem[i].tolist()
+
+    def results(self) -> List[int]:
+        # same value Intcoder.run() returns on halt: the last output, or else address 0
+        first_cells = self.mem[:, 0].tolist()
+        for i, vm in self.scalar.items():
+            first_cells[i] = vm.data[0]
+        return [out[-1] if out else first_cells[i] for i, out in enumerate(self.outputs)]
+
+
+def test():
+    # day 5 comparison program, one VM per input
+    code = [3, 9, 8, 9, 10, 9, 4, 9, 99, -1, 8]
+    batch = BatchIntcoder(code, inputs=[[7], [8], [9]])
+    batch.run()
+    assert batch.results() == [0, 1, 0]
+
+    # one VM overflows int64 and finishes on the scalar engine
+    batch = BatchIntcoder([1002, 7, 3, 7, 4, 7, 99, 0], count=2)
+    batch.mem[:, 7] = [5, 1125899906842624 ** 1 * 4096]
+    batch.run()
+    assert batch.results() == [15, 1125899906842624 * 4096 * 3]
+    assert set(batch.scalar) == {1}
+
+    # 32-bit operands whose product still doesn't fit
+    for x in (4294967295, 3037000500):
+        batch = BatchIntcoder([1102, x, x, 7, 4, 7, 99, 0], count=1)
+        batch.run()
+        assert batch.results() == [x * x] == [Intcoder([1102, x, x, 7, 4, 7, 99, 0]).run()]
+    batch = BatchIntcoder([1102, 3037000499, -3037000499, 7, 4, 7, 99, 0], count=1)
+    batch.run()
+    assert batch.results() == [-3037000499 ** 2] and not batch.scalar
+
+    # VMs starved of input stop without affecting the others
+    batch = BatchIntcoder([3, 0, 3, 1, 4, 1, 99], inputs=[[1, 2], [1]])
+    batch.run()
+    assert batch.state.tolist() == [BatchState.Halted, BatchState.NeedInput]
+    print("BatchIntcoder tests passed.")
+
+
+if __name__ == "__main__":
+    test()
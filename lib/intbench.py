@@ -0,0 +1,245 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+from itertools import permutations
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple, Type
+
+import day7 as amplifiers
+import day11 as robot
+import day13 as arcade
+from lib.intbatch import BatchIntcoder
+from lib.intblocks import BlockIntcoder
+from lib.intcoder import Intcoder
+from lib.intimage import load_program
+from lib.intprofile import Profiler, profiled
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+Program = List[int]
+
+
+class Workload(NamedTuple):
+    name: str
+    filename: str
+    expected: Tuple
+    run: Callable[[Type[Intcoder], Program], Tuple]
+    # the batch engine only has to answer the leading parts it can run
+    batch: Optional[Callable[[Program], Tuple]] = None
+    # run takes workers and sweeps over that many processes
+    parallel: bool = False
+
+
+class Measurement(NamedTuple):
+    workload: str
+    engine: str
+    # None for the batch engine, which doesn't run the same instructions as the workload
+    instructions: Optional[int]
+    wall: float
+    ips: Optional[float]
+    peak_memory: int
+    answer: Any
+    correct: bool
+
+
+def day2(engine: Type[Intcoder], program: Program) -> Tuple:
+    template = engine(program)
+    results = {}
+    for noun in range(100):
+        for verb in range(100):
+            vm = template.fork()
+            vm.putaddr(1, noun)
+            vm.putaddr(2, verb)
+            results.setdefault(vm.run(), noun * 100 + verb)
+    first = template.fork()
+    first.putaddr(1, 12)
+    first.putaddr(2, 2)
+    return first.run(), results[19690720]
+
+
+def day2_batch(program: Program) -> Tuple:
+    batch = BatchIntcoder(program, count=100 * 100)
+    batch.mem[:, 1] = [x // 100 for x in range(100 * 100)]
+    batch.mem[:, 2] = [x % 100 for x in range(100 * 100)]
+    batch.run()
+    results = batch.results()
+    return results[12 * 100 + 2], results.index(19690720)
+
+
+def day5(engine: Type[Intcoder], program: Program) -> Tuple:
+    return engine(program, [1]).run(), engine(program, [5]).run()
+
+
+def day7(engine: Type[Intcoder], program: Program, workers: int = None) -> Tuple:
+    # the script's own paths: memoized chains, then scheduled feedback loops swept over worker processes
+    return (max(amplifiers.chain_results(program, engine).values()),
+            max(amplifiers.feedback_results(program, engine, workers).values()))
+
+
+def day7_batch(program: Program) -> Tuple:
+    phase_sets = list(permutations(range(5)))
+    signals = [0] * len(phase_sets)
+    for stage in range(5):
+        batch = BatchIntcoder(program, inputs=[[phases[stage], signal] for signal, phases in zip(signals, phase_sets)])
+        batch.run()
+        signals = batch.results()
+    return (max(signals),)
+
+
+def day9(engine: Type[Intcoder], program: Program) -> Tuple:
+    return engine(program, [1]).run(), engine(program, [2]).run()
+
+
+def day11(engine: Type[Intcoder], program: Program) -> Tuple:
+    return robot.paint(program, engine=engine), robot.paint(program, robot.MapToken.White, engine)
+
+
+def day13(engine: Type[Intcoder], program: Program) -> Tuple:
+    return arcade.count_blocks(program, engine), arcade.play(program, engine)
+
+
+WORKLOADS = [
+    Workload("day2", "day2.csv", (3101844, 8478), day2, day2_batch),
+    Workload("day5", "day5.csv", (15314507, 652726), day5),
+    Workload("day7", "day7.csv", (22012, 4039164), day7, day7_batch, parallel=True),
+    Workload("day9", "day9.csv", (3765554916, 76642), day9),
+    Workload("day11", "day11.csv", (2129, 249), day11),
+    Workload("day13", "day13.csv", (329, 15973), day13),
+]
+
+ENGINES: Dict[str, Type[Intcoder]] = {
+    "Intcoder": Intcoder,
+    "BlockIntcoder": BlockIntcoder,
+}
+BATCH_ENGINE = "BatchIntcoder"
+
+
+def profile_workload(workload: Workload, program: Program, engine: Type[Intcoder] = Intcoder) -> Profiler:
+    # every VM the workload creates reports into the same profiler
+    profiler = Profiler(None)
+
+    class Counting(profiled(engine)):
+        def __init__(self, *args):
+            super().__init__(*args)
+            self.profiler = profiler
+
+    # sweeps run in this process, a profiler in a worker would keep its counts to itself
+    if workload.parallel:
+        workload.run(Counting, program, workers=0)
+    else:
+        workload.run(Counting, program)
+    return profiler
+
+
+def count_instructions(workload: Workload, program: Program) -> int:
+    # every engine executes the same instructions, so count them once on a profiled interpreter
+    return profile_workload(workload, program).instructions
+
+
+def measure(workload: Workload, engine: str, program: Program, instructions: int, repeat: int) -> Measurement:
+    if engine == BATCH_ENGINE:
+        # it answers fewer parts and runs every lane in lockstep, so the workload's count doesn't apply
+        runner = lambda: workload.batch(program)
+        instructions = None
+    else:
+        runner = lambda: workload.run(ENGINES[engine], program)
+
+    wall = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        answer = runner()
+        wall = min(wall, time.perf_counter() - start)
+
+    # a separate traced run, tracemalloc would skew the timings
+    tracemalloc.start()
+    try:
+        runner()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    ips = instructions / wall if instructions is not None else None
+    return Measurement(workload.name, engine, instructions, wall, ips, peak,
+                       list(answer), tuple(answer) == workload.expected[:len(answer)])
+
+
+def run_benchmarks(names: List[str] = None, engines: List[str] = None, repeat: int = 1) -> List[Measurement]:
+    engines = engines or list(ENGINES) + [BATCH_ENGINE]
+    results = []
+    for workload in WORKLOADS:
+        if names and workload.name not in names:
+            continue
+        program = load_program(os.path.join(ROOT, workload.filename))
+        instructions = count_instructions(workload, program)
+        for engine in engines:
+            if engine == BATCH_ENGINE and not workload.batch:
+                continue
+            result = measure(workload, engine, program, instructions, repeat)
+            print(f"{result.workload:>6} {result.engine:>14} {result.wall * 1000:10.2f} ms "
+                  f"{'n/a' if result.ips is None else f'{result.ips:.0f}':>12} ips {result.peak_memory / 1024:10.1f} KiB"
+                  f"{'' if result.correct else '  WRONG ' + str(result.answer)}")
+            results.append(result)
+    return results
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save(results: List[Measurement], filename: str):
+    with open(filename, "w") as outfile:
+        json.dump({
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "results": [x._asdict() for x in results],
+        }, outfile, indent=4)
+
+
+def compare(results: List[Measurement], filename: str = None, tolerance: float = 0.1) -> List[str]:
+    """
+    Regressions: wrong answers, or runs more than tolerance slower than in a saved results file.
+    """
+    baseline = {}
+    if filename:
+        with open(filename, "r") as infile:
+            baseline = {(x["workload"], x["engine"]): x for x in json.load(infile)["results"]}
+    regressions = []
+    for result in results:
+        before = baseline.get((result.workload, result.engine))
+        if not result.correct:
+            regressions.append(f"{result.workload}/{result.engine}: wrong answer {result.answer}")
+        elif before and result.wall > before["wall"] * (1 + tolerance):
+            regressions.append(f"{result.workload}/{result.engine}: {before['wall'] * 1000:.2f} ms "
+                               f"-> {result.wall * 1000:.2f} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Intcode engines on the puzzle programs.")
+    parser.add_argument("workloads", nargs="*", help="workload names, all by default")
+    parser.add_argument("--engine", action="append", help="engine name, all by default")
+    parser.add_argument("--repeat", type=int, default=1, help="timed runs per engine, the fastest counts")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", help="report regressions against this results file")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed slowdown when comparing")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.workloads, args.engine, args.repeat)
+    if args.json:
+        save(results, args.json)
+    regressions = compare(results, args.compare, args.tolerance)
+    for line in regressions:
+        print(f"REGRESSION {line}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
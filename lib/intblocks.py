@@ -0,0 +1,439 @@
+import atexit
+import hashlib
+import importlib.util
+import marshal
+import os
+from enum import IntEnum
+from types import CodeType
+from typing import Callable, Dict, List, Optional, Sequence, Set, Tuple, Union
+
+from lib.intcoder import (MODE_DIVISORS, OPCODES, PAGE_BITS, PAGE_MASK, PARAM_COUNTS, Instruction, Intcoder, Mem,
+                          Opcode, ParamMode, ReturnVal, RunLimits, RunResult, StopOn)
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "__pycache__", "intblocks")
+CACHE_VERSION = 2
+MAX_BLOCK_INSTRS = 64
+MAX_VARIANTS = 16
+MAX_IMAGES = 64
+COMPILE_THRESHOLD = 16
+
+
+class BlockExit(IntEnum):
+    Next = 0
+    Output = 1
+    Modified = 2
+    Fault = 3
+
+
+BlockFn = Callable[[Dict, Dict, Set[int], int], Tuple[int, int, int, int]]
+
+
+class Block:
+    """
+    A compiled run of straight-line Intcode from start up to (not including) end.
+    expected holds the cells it was compiled from, so other VMs can check it still applies.
+    """
+    start: int
+    end: int
+    expected: Tuple[int, ...]
+    code: CodeType
+    fn: BlockFn
+
+    def __init__(self, start: int, end: int, expected: Tuple[int, ...], code: CodeType):
+        self.start = start
+        self.end = end
+        self.expected = expected
+        self.code = code
+        namespace = {}
+        exec(code, namespace)
+        self.fn = namespace["block"]
+
+    def matches(self, cells: Sequence[int]) -> bool:
+        # patched variants usually differ early, so stop at the first cell that doesn't match
+        return all(cells[x] == value for x, value in enumerate(self.expected, self.start))
+
+
+class BlockCompiler:
+    mem: Mem
+    volatile: Set[int]
+    lines: List[str]
+
+    def __init__(self, mem: Mem, volatile: Set[int]):
+        self.mem = mem
+        self.volatile = volatile
+        self.lines = []
+
+    def decode(self, addr: int) -> Optional[Instruction]:
+        raw_opcode = self.mem[addr]
+        if raw_opcode < 0 or raw_opcode % 100 not in OPCODES:
+            return None
+        opcode = Opcode(raw_opcode % 100)
+        num_params = PARAM_COUNTS[opcode]
+        modes = tuple(ParamMode(raw_opcode // MODE_DIVISORS[x] % 10) for x in range(num_params))
+        params = tuple(self.mem[addr + x + 1] for x in range(num_params))
+        instr = Instruction(opcode, params, modes)
+        if any(x in self.volatile for x in range(addr, addr + instr.size)):
+            return None
+        return instr
+
+    @staticmethod
+    def cell(mode: ParamMode, param: int, pages: str = "V") -> str:
+        if mode == ParamMode.Relative:
+            return f"{pages}[(rb + {param}) >> {PAGE_BITS}][(rb + {param}) & {PAGE_MASK}]"
+        return f"{pages}[{param >> PAGE_BITS}][{param & PAGE_MASK}]"
+
+    def load(self, instr: Instruction, i: int) -> str:
+        if instr.modes[i] == ParamMode.Immediate:
+            return str(instr.params[i])
+        return self.cell(instr.modes[i], instr.params[i])
+
+    def emit(self, line: str, depth: int):
+        self.lines.append("    " * depth + line)
+
+    def emit_store(self, instr: Instruction, expr: str, next_addr: int, depth: int):
+        mode, param = instr.modes[2], instr.params[2]
+        if mode == ParamMode.Relative:
+            self.emit(f"a = rb + {param}", depth)
+            self.emit(f"P[a >> {PAGE_BITS}][a & {PAGE_MASK}] = {expr}", depth)
+            self.emit("if a in T:", depth)
+        else:
+            self.emit(f"{self.cell(mode, param, 'P')} = {expr}", depth)
+            self.emit(f"if {param} in T:", depth)
+        self.emit(f"return {next_addr}, rb, {BlockExit.Modified.value}, " +
+                  ("a" if mode == ParamMode.Relative else str(param)), depth + 1)
+
+    def emit_jump(self, instr: Instruction, start: int, loops: bool, depth: int):
+        target = instr.params[1]
+        if loops and instr.modes[1] == ParamMode.Immediate and target == start:
+            self.emit("continue", depth)
+        else:
+            self.emit(f"return {self.load(instr, 1)}, rb, {BlockExit.Next.value}, 0", depth)
+
+    def compile(self, start: int) -> Optional[Block]:
+        instrs: List[Tuple[int, Instruction]] = []
+        addr = start
+        while len(instrs) < MAX_BLOCK_INSTRS:
+            instr = self.decode(addr)
+            if instr is None or instr.opcode in (Opcode.Input, Opcode.Halt):
+                break
+            instrs.append((addr, instr))
+            addr += instr.size
+            if instr.opcode == Opcode.Output or self.jump_kind(instr) == "always":
+                break
+        if not instrs:
+            return None
+        end = addr
+
+        loops = any(self.jump_kind(x) in ("always", "maybe") and x.modes[1] == ParamMode.Immediate and x.params[1] == start
+                    for _, x in instrs)
+        self.lines = ["def block(V, P, T, rb):", f"    pc = {start}", "    try:"]
+        depth = 2
+        if loops:
+            self.emit("while True:", depth)
+            depth += 1
+
+        terminated = False
+        for addr, instr in instrs:
+            next_addr = addr + instr.size
+            self.emit(f"pc = {addr}", depth)
+            op = instr.opcode
+            if op == Opcode.Add:
+                self.emit_store(instr, f"{self.load(instr, 0)} + {self.load(instr, 1)}", next_addr, depth)
+            elif op == Opcode.Mul:
+                self.emit_store(instr, f"{self.load(instr, 0)} * {self.load(instr, 1)}", next_addr, depth)
+            elif op == Opcode.LessThan:
+                self.emit_store(instr, f"1 if {self.load(instr, 0)} < {self.load(instr, 1)} else 0", next_addr, depth)
+            elif op == Opcode.Equals:
+                self.emit_store(instr, f"1 if {self.load(instr, 0)} == {self.load(instr, 1)} else 0", next_addr, depth)
+            elif op == Opcode.ChangePtrOffset:
+                self.emit(f"rb += {self.load(instr, 0)}", depth)
+            elif op == Opcode.Output:
+                self.emit(f"return {next_addr}, rb, {BlockExit.Output.value}, {self.load(instr, 0)}", depth)
+                terminated = True
+            elif op in (Opcode.JumpIfTrue, Opcode.JumpIfFalse):
+                kind = self.jump_kind(instr)
+                if kind == "always":
+                    self.emit_jump(instr, start, loops, depth)
+                    terminated = True
+                elif kind == "maybe":
+                    test = "!=" if op == Opcode.JumpIfTrue else "=="
+                    self.emit(f"if {self.load(instr, 0)} {test} 0:", depth)
+                    self.emit_jump(instr, start, loops, depth + 1)
+        if not terminated:
+            self.emit(f"return {end}, rb, {BlockExit.Next.value}, 0", depth)
+        self.emit("except (KeyError, OverflowError):", 1)
+        self.emit(f"return pc, rb, {BlockExit.Fault.value}, 0", 2)
+
+        source = "\n".join(self.lines) + "\n"
+        code = compile(source, f"<intblock {start}:{end}>", "exec")
+        return Block(start, end, tuple(self.mem[x] for x in range(start, end)), code)
+
+    @staticmethod
+    def jump_kind(instr: Instruction) -> Optional[str]:
+        if instr.opcode not in (Opcode.JumpIfTrue, Opcode.JumpIfFalse):
+            return None
+        if instr.modes[0] != ParamMode.Immediate:
+            return "maybe"
+        taken = (instr.params[0] != 0) == (instr.opcode == Opcode.JumpIfTrue)
+        return "always" if taken else "never"
+
+
+class BlockCache:
+    """
+    Blocks compiled for one program image, shared by every VM in the process
+    and persisted under CACHE_DIR keyed by a hash of the image. A start address
+    keeps a few variants, since programs often patch operands before running them.
+    Heat counts how often code was interpreted by any VM on the image, so short-lived forks
+    warm it up together. Code some VM has rewritten under a compiled block stays interpreted.
+    """
+    images: Dict[Tuple[int, ...], "BlockCache"] = {}
+
+    image: Tuple[int, ...]
+    key: str
+    blocks: Dict[int, List[Block]]
+    heat: Dict[int, int]
+    rewritten: Set[int]
+    dirty: bool
+
+    def __init__(self, image: Tuple[int, ...], key: str):
+        self.image = image
+        self.key = key
+        self.blocks = {}
+        self.heat = {}
+        self.rewritten = set()
+        self.dirty = False
+        self.load()
+
+    @staticmethod
+    def for_image(data: Sequence[int]) -> "BlockCache":
+        image = tuple(data)
+        cache = BlockCache.images.get(image)
+        if cache is None:
+            if len(BlockCache.images) >= MAX_IMAGES:
+                oldest = next(iter(BlockCache.images))
+                BlockCache.images.pop(oldest).save()
+            key = hashlib.sha1(",".join(str(x) for x in image).encode()).hexdigest()
+            cache = BlockCache.images[image] = BlockCache(image, key)
+        return cache
+
+    @property
+    def path(self) -> Optional[str]:
+        if not CACHE_DIR:
+            return None
+        return os.path.join(CACHE_DIR, f"{self.key}-v{CACHE_VERSION}-{importlib.util.MAGIC_NUMBER.hex()}.bin")
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "rb") as infile:
+                stored = marshal.load(infile)
+            for start, end, expected, code in stored:
+                self.blocks.setdefault(start, []).append(Block(start, end, expected, code))
+        except (EOFError, ValueError, TypeError):
+            self.blocks = {}
+
+    def save(self):
+        if not self.path or not self.dirty:
+            return
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        stored = [(x.start, x.end, x.expected, x.code) for variants in self.blocks.values() for x in variants]
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as outfile:
+            marshal.dump(stored, outfile)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    @staticmethod
+    def save_all():
+        for cache in BlockCache.images.values():
+            cache.save()
+
+    def find(self, start: int, mem: Mem) -> Optional[Block]:
+        for block in self.blocks.get(start, ()):
+            if block.matches(mem):
+                return block
+        return None
+
+    def compile(self, start: int, mem: Mem, volatile: Set[int]) -> Optional[Block]:
+        # a variant another VM already compiled is reused, only new ones take up a slot
+        block = self.find(start, mem)
+        if block is not None:
+            return block
+        # code patched more ways than MAX_VARIANTS stays interpreted rather than compiled by every VM
+        variants = self.blocks.get(start, [])
+        if len(variants) >= MAX_VARIANTS:
+            return None
+        block = BlockCompiler(mem, volatile).compile(start)
+        if block:
+            self.blocks[start] = variants + [block]
+            self.dirty = True
+        return block
+
+
+atexit.register(BlockCache.save_all)
+
+
+class BlockIntcoder(Intcoder):
+    """
+    Intcoder that runs straight-line code as compiled Python functions and
+    only interprets I/O, halts and code the program has rewritten.
+    """
+    cache: BlockCache
+    blocks: Dict[int, Union[BlockFn, bool]]
+    blockcells: Dict[int, List[int]]
+    volatile: Set[int]
+    compile_threshold: int = COMPILE_THRESHOLD
+
+    def __init__(self, data, input_buffer: List[int] = None):
+        super().__init__(data, input_buffer)
+        self.cache = BlockCache.for_image(data)
+        self.blocks = {}
+        self.blockcells = {}
+        self.volatile = set()
+
+    def execute(self, stop_on: StopOn, max_steps: Optional[int], max_outputs: Optional[int]) -> ReturnVal:
+        # blocks run whole loops at a time, so instruction budgets are kept by the interpreter
+        if max_steps is not None:
+            return super().execute(stop_on, max_steps, max_outputs)
+        limits = RunLimits(self, stop_on, max_steps, max_outputs)
+        stopped = limits.start()
+        if stopped:
+            return stopped
+        view, pages = self.data.view, self.data.pages
+        blocks = self.blocks
+        while True:
+            block = blocks.get(self.ptr)
+            if block is None:
+                block = self.compile_block(self.ptr)
+
+            if block:
+                # codecells is looked up each time, a trap may have swapped in a private copy
+                self.ptr, self.ptroffset, event, value = block(view, pages, self.codecells, self.ptroffset)
+                if event == BlockExit.Next:
+                    continue
+                if event == BlockExit.Output:
+                    self.emit(value)
+                    stopped = limits.output()
+                    if stopped:
+                        return stopped
+                    continue
+                if event == BlockExit.Modified:
+                    self.trap(value)
+                    continue
+                # a page was missing, shared or overflowed: prepare it and interpret the instruction
+                instr = self.peek_instr()
+                for i, mode in enumerate(instr.modes):
+                    if mode != ParamMode.Immediate:
+                        # compiled code only ever writes through the third operand
+                        self.data.touch(self.addr(instr, i), writable=i == 2)
+
+            instr = self.peek_instr()
+            if instr.opcode == Opcode.Input and limits.input_blocked():
+                return ReturnVal(RunResult.NeedInput, 0)
+
+            self.ptr += instr.size
+            rs = instr.handler(self, instr)
+            if rs is not None:
+                return ReturnVal(RunResult.Halted, rs)
+
+            if instr.opcode == Opcode.Output:
+                stopped = limits.output()
+                if stopped:
+                    return stopped
+
+    def fork(self) -> "BlockIntcoder":
+        child = super().fork()
+        child.blocks = dict(self.blocks)
+        child.blockcells = {k: list(v) for k, v in self.blockcells.items()}
+        child.volatile = set(self.volatile)
+        return child
+
+    def compile_block(self, start: int) -> Union[BlockFn, bool]:
+        # reuse a cached block straight away, but only compile code once it has run a few times
+        cache = self.cache
+        heat = cache.heat.get(start, 0)
+        if start in cache.rewritten:
+            block = None
+        elif heat >= self.compile_threshold:
+            block = cache.compile(start, self.data, self.volatile)
+        else:
+            block = cache.find(start, self.data)
+            if block is None:
+                cache.heat[start] = heat + 1
+                return False
+
+        if block:
+            compiled, end = block.fn, block.end
+        else:
+            compiled, end = False, start + 1
+        self.blocks[start] = compiled
+        self.own_code()
+        for x in range(start, end):
+            self.codecells.add(x)
+            self.blockcells.setdefault(x, []).append(start)
+        return compiled
+
+    def is_code(self, addr: int) -> bool:
+        return addr in self.blockcells or super().is_code(addr)
+
+    def untrap(self, addr: int):
+        super().untrap(addr)
+        self.volatile.discard(addr)
+
+    def invalidate(self, addr: int):
+        super().invalidate(addr)
+        self.volatile.add(addr)
+        for start in self.blockcells.pop(addr, ()):
+            if self.blocks.pop(start, None):
+                # forks would otherwise each compile and then throw away the same block
+                self.cache.rewritten.add(start)
+
+
+def test():
+    # self-modifying loop: the compiled block must drop out once its Output operand is rewritten
+    coder = BlockIntcoder([104, 0, 101, 1, 1, 1, 1007, 1, 40, 20, 1005, 20, 0, 99])
+    coder.run()
+    assert coder.outbuffer == list(range(40)) and coder.cache.rewritten
+
+    # compiled outputs count towards max_outputs, budgets fall back to counting interpreted steps
+    coder = BlockIntcoder([104, 0, 101, 1, 1, 1, 1007, 1, 40, 20, 1005, 20, 0, 99])
+    coder.compile_threshold = 0
+    assert coder.run(max_outputs=25) == (RunResult.HasOutput, 24)
+    assert coder.run(max_steps=4).result == RunResult.OutOfSteps and coder.outbuffer[-1] == 25
+    assert coder.run() == 39
+
+    # relative writes far past the image fault into the interpreter and come back
+    coder = BlockIntcoder([109, 5000, 21101, 3, 4, 0, 204, 0, 99])
+    coder.compile_threshold = 0
+    assert coder.run() == 7
+
+    # writes that overflow int64 promote the page
+    coder = BlockIntcoder([1102, 34915192, 34915192, 11, 1002, 11, 34915192, 11, 4, 11, 99, 0])
+    coder.compile_threshold = 0
+    assert coder.run() == 34915192 ** 3
+    # short-lived forks warm the same code up together
+    template = BlockIntcoder([3, 11, 1001, 11, 7, 11, 4, 11, 99, 0, 0, 0, 0])
+    template.compile_threshold = 3
+    results = [template.fork().run([x]) for x in range(5)]
+    assert results == [7, 8, 9, 10, 11] and template.cache.find(2, template.data) is not None
+
+    # a watched data cell stops trapping and counting as rewritten once it is unwatched
+    coder = BlockIntcoder([104, 0, 101, 1, 1, 1, 1007, 1, 40, 20, 1005, 20, 0, 99])
+    coder.compile_threshold = 0
+    watch = coder.watch(20)
+    coder.run()
+    assert watch.events and 20 in coder.volatile
+    coder.unwatch(watch)
+    assert 20 not in coder.codecells and 20 not in coder.volatile
+
+    # VMs that compile the same code share one variant
+    code = [104, 0, 101, 1, 1, 1, 1007, 1, 40, 20, 1005, 20, 0, 99]
+    cache = BlockCache(tuple(code), "test")
+    blocks = [cache.compile(2, Mem(code), set()) for _ in range(3)]
+    assert blocks[0] is blocks[1] is blocks[2] and len(cache.blocks[2]) == 1
+    print("BlockIntcoder tests passed.")
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,186 @@
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from typing import List, Sequence, Tuple, Union
+
+from lib.intcoder import PAGE_BITS, PAGE_SIZE, Intcoder, Mem, ReturnVal, RunResult, StopOn
+
+MAGIC = b"ICKP"
+CHECKPOINT_VERSION = 2
+CHECKPOINT_STEPS = 1_000_000
+
+# magic, version, image sha1, ptr, ptroffset
+HEADER = struct.Struct("<4sH20sqq")
+# kind, count: b"q" for int64 values, b"w" for values that need more
+SECTION = struct.Struct("<cI")
+WIDE_LEN = struct.Struct("<I")
+
+Image = Union[Sequence[int], Intcoder]
+
+
+def image_hash(image: Image) -> bytes:
+    cells = image.data if isinstance(image, Intcoder) else image
+    return hashlib.sha1(",".join(str(x) for x in cells).encode()).digest()
+
+
+def pack_values(values: Sequence[int]) -> bytes:
+    try:
+        packed = array("q", values)
+    except OverflowError:
+        parts = [SECTION.pack(b"w", len(values))]
+        for x in values:
+            raw = x.to_bytes((x.bit_length() + 8) // 8, "little", signed=True)
+            parts += [WIDE_LEN.pack(len(raw)), raw]
+        return b"".join(parts)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return SECTION.pack(b"q", len(values)) + packed.tobytes()
+
+
+def unpack_values(blob, offset: int) -> Tuple[List[int], int]:
+    kind, count = SECTION.unpack_from(blob, offset)
+    offset += SECTION.size
+    if kind == b"q":
+        values = array("q")
+        values.frombytes(blob[offset:offset + count * 8])
+        if sys.byteorder == "big":
+            values.byteswap()
+        return values.tolist(), offset + count * 8
+    values = []
+    for _ in range(count):
+        (size,) = WIDE_LEN.unpack_from(blob, offset)
+        offset += WIDE_LEN.size
+        values.append(int.from_bytes(blob[offset:offset + size], "little", signed=True))
+        offset += size
+    return values, offset
+
+
+def changed_cells(mem: Mem, base: Mem) -> Tuple[List[int], List[int]]:
+    addrs, values = [], []
+    for pagenum, page in sorted(mem.view.items()):
+        original = base.view.get(pagenum)
+        if page is original:
+            continue
+        start = pagenum << PAGE_BITS
+        for i in range(PAGE_SIZE):
+            if page[i] != (original[i] if original is not None else 0):
+                addrs.append(start + i)
+                values.append(page[i])
+    return addrs, values
+
+
+def checkpoint(vm: Intcoder, image: Image) -> bytes:
+    """
+    Binary state of vm: registers, queued input, buffered output and the memory cells that differ from image.
+    A live input source is not saved, only the values it already handed over.
+    """
+    base = image.data if isinstance(image, Intcoder) else Mem(image)
+    addrs, values = changed_cells(vm.data, base)
+    lastout = [] if vm.lastout is None else [vm.lastout]
+    return b"".join([
+        HEADER.pack(MAGIC, CHECKPOINT_VERSION, image_hash(image), vm.ptr, vm.ptroffset),
+        pack_values(lastout),
+        pack_values(list(vm.inbuffer)),
+        pack_values(vm.outbuffer),
+        pack_values(addrs),
+        pack_values(values),
+    ])
+
+
+def restore(blob, image: Image, engine=Intcoder) -> Intcoder:
+    """
+    VM rebuilt from a checkpoint of a run of image. A template VM as image is forked, so its memory is shared.
+    """
+    magic, version, digest, ptr, ptroffset = HEADER.unpack_from(blob, 0)
+    if magic != MAGIC or version != CHECKPOINT_VERSION:
+        raise ValueError(f"Not a version {CHECKPOINT_VERSION} Intcoder checkpoint")
+    if digest != image_hash(image):
+        raise ValueError("Checkpoint was taken from a different program")
+
+    offset = HEADER.size
+    lastout, offset = unpack_values(blob, offset)
+    inbuffer, offset = unpack_values(blob, offset)
+    outbuffer, offset = unpack_values(blob, offset)
+    addrs, offset = unpack_values(blob, offset)
+    values, offset = unpack_values(blob, offset)
+
+    vm = image.fork() if isinstance(image, Intcoder) else engine(image)
+    for addr, value in zip(addrs, values):
+        vm.putaddr(addr, value)
+    vm.ptr, vm.ptroffset = ptr, ptroffset
+    vm.inbuffer = inbuffer
+    vm.outbuffer = outbuffer
+    vm.lastout = lastout[0] if lastout else None
+    return vm
+
+
+def save(vm: Intcoder, image: Image, path: str):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as outfile:
+        outfile.write(checkpoint(vm, image))
+    os.replace(tmp_path, path)
+
+
+def load(path: str, image: Image, engine=Intcoder) -> Intcoder:
+    with open(path, "rb") as infile, mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        return restore(mapped, image, engine)
+
+
+def run_checkpointed(vm: Intcoder, image: Image, path: str, stop_on: StopOn = StopOn.Halt,
+                     every: int = CHECKPOINT_STEPS) -> ReturnVal:
+    """
+    Run vm in slices of every instructions, saving a checkpoint to path after each one.
+    After a crash, load(path, image) picks the run up from the last slice.
+    """
+    while True:
+        rs = vm.run(stop_on=stop_on, max_steps=every)
+        save(vm, image, path)
+        if rs.result != RunResult.OutOfSteps:
+            return rs
+
+
+def test():
+    # counts cell 20 up to 1000, then outputs it
+    code = [1001, 20, 1, 20, 1008, 20, 1000, 21, 1006, 21, 0, 4, 20, 99]
+    vm = Intcoder(code)
+    vm.run(max_steps=1000)
+    restored = restore(checkpoint(vm, code), code)
+    assert (restored.ptr, restored.data[20]) == (vm.ptr, vm.data[20])
+    assert restored.run() == 1000
+
+    # forks of a template share its pages, values wider than int64 survive
+    template = Intcoder(code)
+    vm = template.fork()
+    vm.putaddr(5000, -2 ** 100)
+    vm.inbuffer.extend([1, 2])
+    blob = checkpoint(vm, template)
+    restored = restore(blob, template)
+    assert restored.data[5000] == -2 ** 100 and list(restored.inbuffer) == [1, 2]
+    assert restored.data.view[0] is template.data.view[0]
+    # more than 255 bytes of value
+    vm.putaddr(5001, 7 ** 2000)
+    assert restore(checkpoint(vm, template), template).data[5001] == 7 ** 2000
+
+    try:
+        restore(blob, code[:-1])
+        assert False
+    except ValueError:
+        pass
+
+    # a checkpointed run can be resumed from the file it left behind
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "run.ckpt")
+        vm = Intcoder(code)
+        vm.run(max_steps=2500)
+        save(vm, code, path)
+        assert run_checkpointed(load(path, code), code, path, every=500) == (RunResult.Halted, 1000)
+        assert load(path, code).outbuffer == [1000]
+    print("Checkpoint tests passed.")
+
+
+if __name__ == "__main__":
+    test()
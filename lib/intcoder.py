@@ -1,6 +1,9 @@
-from copy import deepcopy
-from enum import IntEnum
-from typing import Dict, List, NamedTuple
+from array import array
+from collections import deque
+from copy import copy
+from enum import IntEnum, IntFlag
+from itertools import islice, repeat
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Set, Tuple, Union
 
 
 class Opcode(IntEnum):
@@ -23,15 +26,21 @@ class ParamMode(IntEnum):
 
 
 class Instruction:
+    __slots__ = ("opcode", "params", "modes", "size", "handler")
+
     opcode: Opcode
-    params: List[int]
-    modes: List[ParamMode]
+    params: Tuple[int, ...]
+    modes: Tuple[ParamMode, ...]
+    size: int
+    handler: Callable[["Intcoder", "Instruction"], Optional[int]]
 
-    def __init__(self, opcode: Opcode):
+    def __init__(self, opcode: Opcode, params: Tuple[int, ...] = None, modes: Tuple[ParamMode, ...] = None):
         self.opcode = opcode
         num_params = PARAM_COUNTS[opcode]
-        self.params = [0] * num_params
-        self.modes = [ParamMode.Positional] * num_params
+        self.params = params if params is not None else (0,) * num_params
+        self.modes = modes if modes is not None else (ParamMode.Positional,) * num_params
+        self.size = num_params + 1
+        self.handler = HANDLERS[opcode]
 
     def __repr__(self):
         mergedparams = [f"{x}({self.modes[i].name})" for i, x in enumerate(self.params)]
@@ -41,10 +50,6 @@ class Instruction:
     def num_params(self):
         return PARAM_COUNTS[self.opcode]
 
-    @property
-    def size(self):
-        return self.num_params + 1
-
 
 PARAM_COUNTS = {
     Opcode.Add: 3,
@@ -59,11 +64,23 @@ PARAM_COUNTS = {
     Opcode.Halt: 0,
 }
 
+MAX_INSTR_SIZE = max(PARAM_COUNTS.values()) + 1
+MODE_DIVISORS = (100, 1000, 10000)
+OPCODES = frozenset(int(x) for x in Opcode)
+
 
 class RunResult(IntEnum):
     Halted = 0,
     NeedInput = 1,
     HasOutput = 2,
+    OutputFull = 3,
+    OutOfSteps = 4,
+
+
+class StopOn(IntFlag):
+    Halt = 0
+    Input = 1
+    Output = 2
 
 
 class ReturnVal(NamedTuple):
@@ -71,81 +88,447 @@ class ReturnVal(NamedTuple):
     output: int
 
 
-class Mem(list):
-    values: Dict[int, int]
+Source = Union[Deque[int], Iterator[int], Callable[[], Optional[int]]]
+
+
+class RunLimits:
+    """
+    The stop conditions of one execute() call. Every run loop asks it when input is needed
+    and after each output, and iterates over steps to keep the instruction budget.
+    """
+    vm: "Intcoder"
+    stop_on_input: bool
+    outputs_left: int
+    # values handed to a sink during this run
+    emitted: int
+    # output needs checking at all: a plain run without outlimit only stops on halt
+    watch_outputs: bool
+    steps: Iterable
+
+    def __init__(self, vm: "Intcoder", stop_on: StopOn, max_steps: Optional[int], max_outputs: Optional[int]):
+        self.vm = vm
+        self.stop_on_input = bool(stop_on & StopOn.Input)
+        self.outputs_left = 1 if stop_on & StopOn.Output else max_outputs or 0
+        self.emitted = 0
+        self.watch_outputs = self.stop_on_input or bool(self.outputs_left) or vm.outlimit is not None
+        self.steps = repeat(None) if max_steps is None else range(max_steps)
+
+    def start(self) -> Optional[ReturnVal]:
+        if self.full():
+            return ReturnVal(RunResult.OutputFull, 0)
+        return None
+
+    def full(self) -> bool:
+        vm = self.vm
+        if vm.sink is None:
+            return vm.output_full()
+        # a sink takes every value, so the limit is on how many one run hands over before the host gets control
+        return vm.outlimit is not None and self.emitted >= vm.outlimit
+
+    def input_blocked(self) -> bool:
+        return self.stop_on_input and not self.vm.inbuffer
+
+    def output(self) -> Optional[ReturnVal]:
+        self.outputs_left -= 1
+        self.emitted += 1
+        if not self.outputs_left:
+            return ReturnVal(RunResult.HasOutput, self.vm.lastout)
+        if self.full():
+            return ReturnVal(RunResult.OutputFull, 0)
+        return None
+
+
+class InPort(deque):
+    """
+    FIFO input buffer. Once the queued values run out it pulls more from source:
+    another deque, an iterator, or a callable that returns None while it has nothing to give.
+    """
+    source: Optional[Source]
+
+    def __init__(self, source: Union[Iterable[int], Source] = None):
+        super().__init__()
+        self.source = None
+        if isinstance(source, (list, tuple)):
+            self.extend(source)
+        elif isinstance(source, deque) or callable(source):
+            self.source = source
+        elif source is not None:
+            self.source = iter(source)
+
+    def __bool__(self):
+        return len(self) > 0 or self.pull()
+
+    def pull(self) -> bool:
+        source = self.source
+        if source is None:
+            return False
+        if isinstance(source, deque):
+            if not source:
+                return False
+            self.append(source.popleft())
+        elif callable(source):
+            value = source()
+            if value is None:
+                return False
+            self.append(value)
+        else:
+            value = next(source, None)
+            if value is None:
+                self.source = None
+                return False
+            self.append(value)
+        return True
+
+
+PAGE_BITS = 8
+PAGE_SIZE = 1 << PAGE_BITS
+PAGE_MASK = PAGE_SIZE - 1
+
+Page = Union[array, List[int]]
+
+
+def make_page(values: Sequence[int] = ()) -> Page:
+    if not values:
+        return array("q", bytes(PAGE_SIZE * 8))
+    cells = list(values)
+    cells.extend([0] * (PAGE_SIZE - len(cells)))
+    try:
+        return array("q", cells)
+    except OverflowError:
+        return cells
+
+
+class Mem:
+    """
+    Sparse memory split into PAGE_SIZE pages, allocated on first write.
+    Pages are int64 arrays until a value no longer fits, then plain lists.
+    Reads go through view, which also holds pages shared with other Mems;
+    pages holds only the ones this Mem owns and may write in place.
+    """
+    pages: Dict[int, Page]
+    view: Dict[int, Page]
+    size: int
 
     def __init__(self, data):
-        super().__init__()
-        self.values = {}
+        self.pages = {}
+        self.view = {}
+        self.size = 0
         self.init(data)
 
-    def init(self, data: List):
-        for i in range(len(data)):
-            self.values[i] = data[i]
+    def init(self, data: Sequence[int]):
+        for start in range(0, len(data), PAGE_SIZE):
+            self.view[start >> PAGE_BITS] = self.pages[start >> PAGE_BITS] = make_page(data[start:start + PAGE_SIZE])
+        self.size = max(self.size, len(data))
+
+    def share(self) -> Dict[int, Page]:
+        # give up ownership of every page; whoever writes one next copies it first
+        self.pages.clear()
+        return self.view
+
+    def fork(self) -> "Mem":
+        mem = Mem(())
+        mem.view = dict(self.share())
+        mem.size = self.size
+        return mem
 
     def __setitem__(self, key, value):
-        self.values[key] = value
+        try:
+            self.pages[key >> PAGE_BITS][key & PAGE_MASK] = value
+        except KeyError:
+            self.touch(key)
+            self[key] = value
+        except OverflowError:
+            page = self.view[key >> PAGE_BITS] = self.pages[key >> PAGE_BITS] = self.pages[key >> PAGE_BITS].tolist()
+            page[key & PAGE_MASK] = value
+
+    def touch(self, index: int, writable: bool = True):
+        pagenum = index >> PAGE_BITS
+        if pagenum not in (self.pages if writable else self.view):
+            shared = self.view.get(pagenum)
+            self.view[pagenum] = self.pages[pagenum] = shared[:] if shared is not None else make_page()
 
     def __getitem__(self, index):
-        if index in self.values:
-            return self.values[index]
-        return 0
+        try:
+            return self.view[index >> PAGE_BITS][index & PAGE_MASK]
+        except KeyError:
+            return 0
+        except TypeError:
+            if isinstance(index, slice):
+                return [self[i] for i in range(*index.indices(len(self)))]
+            raise
+
+    def __len__(self):
+        # cells past the loaded image only count once they hold a nonzero value
+        size = self.size
+        for pagenum, page in self.view.items():
+            start = pagenum << PAGE_BITS
+            if start + PAGE_SIZE <= size:
+                continue
+            for i in range(PAGE_MASK, -1, -1):
+                if page[i]:
+                    size = max(size, start + i + 1)
+                    break
+        return size
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __eq__(self, other):
+        if not isinstance(other, (Mem, list, tuple)):
+            return NotImplemented
+        return list(self) == list(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+WatchCallback = Callable[[int, int, int], None]
+
+
+class Watch:
+    """
+    Write watchpoint on the cells from start to end. Every write that changes one of them calls
+    callback(addr, old, new), or without a callback is recorded in events.
+    """
+    start: int
+    end: int
+    callback: Optional[WatchCallback]
+    values: Dict[int, int]
+    events: List[Tuple[int, int, int]]
+
+    def __init__(self, start: int, end: int, values: Dict[int, int], callback: WatchCallback = None):
+        self.start = start
+        self.end = end
+        self.callback = callback
+        self.values = values
+        self.events = []
+
+    def update(self, addr: int, value: int):
+        old = self.values[addr]
+        if old != value:
+            self.values[addr] = value
+            if self.callback is None:
+                self.events.append((addr, old, value))
+            else:
+                self.callback(addr, old, value)
 
 
 class Intcoder:
     data: Mem
     ptr: int
     ptroffset: int
-    inbuffer: List[int]
+    inport: InPort
     outbuffer: List[int]
-
-    def __init__(self, data, input_buffer: List[int] = None):
+    outlimit: Optional[int]
+    outsink: Optional[Callable[[int], None]]
+    lastout: Optional[int]
+    decoded: Dict[int, Instruction]
+    # cells whose writes trap: decoded code and watched memory
+    codecells: Set[int]
+    # decoded and codecells are shared with a fork until either side changes them
+    sharedcode: bool
+    watches: Dict[int, List[Watch]]
+
+    def __init__(self, data, input_buffer: Union[Iterable[int], Source] = None):
         self.data = Mem(data)
         self.ptr = 0
         self.ptroffset = 0
-        self.inbuffer = deepcopy(input_buffer) if input_buffer else []
+        self.inbuffer = input_buffer
         self.outbuffer = []
+        self.outlimit = None
+        self.sink = None
+        self.lastout = None
+        self.decoded = {}
+        self.codecells = set()
+        self.sharedcode = False
+        self.watches = {}
 
-    def run(self, input_buffer: List[int] = None):
-        if input_buffer:
-            self.inbuffer = deepcopy(input_buffer)
-        rs = None
-        while rs is None:
-            instr = self.next_instr()
-            rs = self.call(instr)
-        return rs
+    @property
+    def inbuffer(self) -> InPort:
+        return self.inport
 
-    def run_until_input(self) -> ReturnVal:
-        while True:
-            instr = self.next_instr()
-            rs = self.call(instr)
+    @inbuffer.setter
+    def inbuffer(self, source: Union[Iterable[int], Source]):
+        self.inport = source if isinstance(source, InPort) else InPort(source)
 
-            if rs or instr.opcode == Opcode.Halt:
-                return ReturnVal(RunResult.Halted, rs)
+    @property
+    def sink(self) -> Optional[Callable[[int], None]]:
+        return self.outsink
+
+    @sink.setter
+    def sink(self, sink: Optional[Callable[[int], None]]):
+        # values output before the sink was attached go to it first
+        self.outsink = sink
+        if sink is not None and self.outbuffer:
+            for value in self.outbuffer:
+                sink(value)
+            self.outbuffer.clear()
+
+    def run(self, input_buffer: Union[Iterable[int], Source] = None, stop_on: StopOn = StopOn.Halt,
+            max_steps: int = None, max_outputs: int = None):
+        """
+        Run until halt, or until input is needed (StopOn.Input), max_outputs values have been output
+        (StopOn.Output is one), outlimit is reached or max_steps instructions have run. A plain run()
+        returns the halt value, any stop condition makes it return a ReturnVal instead.
+        Input that is needed without StopOn.Input and isn't there raises RuntimeError.
+        """
+        if input_buffer is not None:
+            self.inbuffer = input_buffer
+        if stop_on or max_steps is not None or max_outputs is not None or self.outlimit is not None:
+            return self.execute(stop_on, max_steps, max_outputs)
+        return self.execute(stop_on, None, None).output
 
-            if self.peek_instr().opcode == Opcode.Input and not self.inbuffer:
-                return ReturnVal(RunResult.NeedInput, 0)
+    def run_until_input(self) -> ReturnVal:
+        return self.execute(StopOn.Input, None, None)
 
     def run_until_io(self) -> ReturnVal:  # result, output
-        while True:
-            instr = self.next_instr()
+        return self.execute(StopOn.Input | StopOn.Output, None, None)
+
+    def execute(self, stop_on: StopOn, max_steps: Optional[int], max_outputs: Optional[int]) -> ReturnVal:
+        limits = RunLimits(self, stop_on, max_steps, max_outputs)
+        stopped = limits.start()
+        if stopped:
+            return stopped
+        watch_outputs = limits.watch_outputs
+        for _ in limits.steps:
+            # no local for decoded: any write that traps may swap in a private copy
+            instr = self.decoded.get(self.ptr) or self.decode(self.ptr)
+            if instr.opcode is Opcode.Input and limits.input_blocked():
+                return ReturnVal(RunResult.NeedInput, 0)
 
-            rs = self.call(instr)
-            if rs or instr.opcode == Opcode.Halt:
+            self.ptr += instr.size
+            rs = instr.handler(self, instr)
+            if rs is not None:
                 return ReturnVal(RunResult.Halted, rs)
 
-            if self.peek_instr().opcode == Opcode.Input and not self.inbuffer:
-                return ReturnVal(RunResult.NeedInput, 0)
-
-            if instr.opcode == Opcode.Output:
-                return ReturnVal(RunResult.HasOutput, self.outbuffer[-1])
+            if watch_outputs and instr.opcode is Opcode.Output:
+                stopped = limits.output()
+                if stopped:
+                    return stopped
+        return ReturnVal(RunResult.OutOfSteps, 0)
+
+    def outputs(self, chunk: int = 1) -> Iterator[Union[int, Tuple[int, ...]]]:
+        """
+        Run the program lazily, yielding output values one by one or as chunk-sized tuples.
+        The VM pauses while a chunk is waiting to be consumed. Stops on halt or when out of input.
+        """
+        outlimit, self.outlimit = self.outlimit, None
+        try:
+            while True:
+                rs = self.execute(StopOn.Input, None, chunk)
+                while len(self.outbuffer) >= chunk:
+                    values = self.outbuffer[:chunk]
+                    del self.outbuffer[:chunk]
+                    yield values[0] if chunk == 1 else tuple(values)
+                if rs.result != RunResult.HasOutput:
+                    return
+        finally:
+            self.outlimit = outlimit
+
+    def output_full(self) -> bool:
+        return self.outlimit is not None and len(self.outbuffer) >= self.outlimit
+
+    def emit(self, value: int):
+        self.lastout = value
+        if self.outsink is None:
+            self.outbuffer.append(value)
+        else:
+            self.outsink(value)
 
     def finalstate(self):
         self.run()
         return self.data
 
+    def fork(self) -> "Intcoder":
+        # the child shares memory pages with this VM; each side copies a page before writing it
+        child = copy(self)
+        child.data = self.data.fork()
+        # queued input is copied, a live source stays with the parent
+        child.inbuffer = list(self.inbuffer)
+        child.outbuffer = list(self.outbuffer)
+        self.sharedcode = child.sharedcode = True
+        # watchpoints belong to whoever set them on the parent
+        child.watches = {}
+        return child
+
+    def snapshot(self) -> "Snapshot":
+        return Snapshot(self.fork())
+
+    def restore(self, snapshot: "Snapshot"):
+        self.__dict__.update(snapshot.fork().__dict__)
+
     def putaddr(self, idx: int, val=0):
         self.data[idx] = val
+        if idx in self.codecells:
+            self.trap(idx)
+
+    def watch(self, start: int, end: int = None, callback: WatchCallback = None) -> Watch:
+        """
+        Watch writes to the cells from start to end (just start by default). Watched cells join the trap set
+        decoded code already uses, so writes anywhere else cost nothing extra.
+        """
+        end = start + 1 if end is None else end
+        watch = Watch(start, end, {x: self.data[x] for x in range(start, end)}, callback)
+        self.own_code()
+        for x in range(start, end):
+            self.watches.setdefault(x, []).append(watch)
+            self.codecells.add(x)
+        return watch
+
+    def unwatch(self, watch: Watch):
+        for x in range(watch.start, watch.end):
+            watches = self.watches[x]
+            watches.remove(watch)
+            if not watches:
+                del self.watches[x]
+                if not self.is_code(x):
+                    self.untrap(x)
+
+    def is_code(self, addr: int) -> bool:
+        return any(start in self.decoded and start + self.decoded[start].size > addr
+                   for start in range(addr - MAX_INSTR_SIZE + 1, addr + 1))
+
+    def untrap(self, addr: int):
+        self.own_code()
+        self.codecells.discard(addr)
+
+    def own_code(self):
+        # called before changing decoded or codecells
+        if self.sharedcode:
+            self.decoded = dict(self.decoded)
+            self.codecells = set(self.codecells)
+            self.sharedcode = False
+
+    def trap(self, addr: int):
+        # a write to a trapped cell, after it happened
+        for watch in self.watches.get(addr, ()):
+            watch.update(addr, self.data[addr])
+        self.invalidate(addr)
+
+    def decode(self, addr: int) -> Instruction:
+        raw_opcode = self.data[addr]
+        if raw_opcode < 0 or raw_opcode % 100 not in OPCODES:
+            raise Exception(f"Illegal opcode {raw_opcode} at {addr}. System on fire.")
+        opcode = Opcode(raw_opcode % 100)
+        num_params = PARAM_COUNTS[opcode]
+        modes = tuple(ParamMode(raw_opcode // MODE_DIVISORS[x] % 10) for x in range(num_params))
+        params = tuple(self.data[addr + x + 1] for x in range(num_params))
+
+        instr = Instruction(opcode, params, modes)
+        self.own_code()
+        self.decoded[addr] = instr
+        self.codecells.update(range(addr, addr + instr.size))
+        return instr
+
+    def invalidate(self, addr: int):
+        self.own_code()
+        for start in range(addr - MAX_INSTR_SIZE + 1, addr + 1):
+            instr = self.decoded.get(start)
+            if instr and start + instr.size > addr:
+                del self.decoded[start]
 
     def next_instr(self) -> Instruction:
         instr = self.peek_instr()
@@ -153,79 +536,196 @@ class Intcoder:
         return instr
 
     def peek_instr(self) -> Instruction:
-        raw_opcode = str(self.data[self.ptr])
-        instr = Instruction(Opcode(int(raw_opcode[-2:])))
-
-        def get_mode(param_no: int) -> ParamMode:
-            offset = -3 - param_no
-            modeflag = int(raw_opcode[offset]) if len(raw_opcode) >= abs(offset) else 0
-            return ParamMode(modeflag)
-
-        for x in range(0, instr.num_params):
-            mode = get_mode(x)
-            instr.modes[x] = mode
-            instr.params[x] = self.data[self.ptr + x + 1]
-        return instr
+        return self.decoded.get(self.ptr) or self.decode(self.ptr)
 
     def call(self, instr: Instruction):
-        def resolve_addr(i: int):
-            if instr.modes[i] == ParamMode.Positional:
-                return instr.params[i]
-            elif instr.modes[i] == ParamMode.Relative:
-                return self.ptroffset + instr.params[i]
+        return instr.handler(self, instr)
 
-        def deref(i: int):
-            if instr.modes[i] == ParamMode.Immediate:
-                return instr.params[i]
-            return self.data[resolve_addr(i)]
+    def addr(self, instr: Instruction, i: int) -> int:
+        if instr.modes[i] == ParamMode.Relative:
+            return self.ptroffset + instr.params[i]
+        return instr.params[i]
 
-        if instr.opcode == Opcode.Add:
-            self.putaddr(resolve_addr(2), deref(0) + deref(1))
+    def load(self, instr: Instruction, i: int) -> int:
+        mode = instr.modes[i]
+        if mode == ParamMode.Immediate:
+            return instr.params[i]
+        if mode == ParamMode.Relative:
+            return self.data[self.ptroffset + instr.params[i]]
+        return self.data[instr.params[i]]
 
-        elif instr.opcode == Opcode.Mul:
-            self.putaddr(resolve_addr(2), deref(0) * deref(1))
+    def op_add(self, instr: Instruction):
+        self.putaddr(self.addr(instr, 2), self.load(instr, 0) + self.load(instr, 1))
 
-        elif instr.opcode == Opcode.Input:
-            self.putaddr(resolve_addr(0), self.readbuffer())
+    def op_mul(self, instr: Instruction):
+        self.putaddr(self.addr(instr, 2), self.load(instr, 0) * self.load(instr, 1))
 
-        elif instr.opcode == Opcode.Output:
-            self.outbuffer.append(deref(0))
+    def op_input(self, instr: Instruction):
+        if not self.inbuffer:
+            # stay on the input, so the host can queue a value and carry on
+            self.ptr -= instr.size
+            raise RuntimeError(f"Input needed at {self.ptr} and none queued; run with StopOn.Input to wait for it")
+        self.putaddr(self.addr(instr, 0), self.readbuffer())
 
-        elif instr.opcode == Opcode.JumpIfTrue:
-            if not deref(0) == 0:
-                self.ptr = deref(1)
+    def op_output(self, instr: Instruction):
+        self.emit(self.load(instr, 0))
 
-        elif instr.opcode == Opcode.JumpIfFalse:
-            if deref(0) == 0:
-                self.ptr = deref(1)
+    def op_jump_if_true(self, instr: Instruction):
+        if self.load(instr, 0) != 0:
+            self.ptr = self.load(instr, 1)
 
-        elif instr.opcode == Opcode.LessThan:
-            self.putaddr(resolve_addr(2), 1 if deref(0) < deref(1) else 0)
+    def op_jump_if_false(self, instr: Instruction):
+        if self.load(instr, 0) == 0:
+            self.ptr = self.load(instr, 1)
 
-        elif instr.opcode == Opcode.Equals:
-            self.putaddr(resolve_addr(2), 1 if deref(0) == deref(1) else 0)
+    def op_less_than(self, instr: Instruction):
+        self.putaddr(self.addr(instr, 2), 1 if self.load(instr, 0) < self.load(instr, 1) else 0)
 
-        elif instr.opcode == Opcode.ChangePtrOffset:
-            self.ptroffset += deref(0)
+    def op_equals(self, instr: Instruction):
+        self.putaddr(self.addr(instr, 2), 1 if self.load(instr, 0) == self.load(instr, 1) else 0)
 
-        elif instr.opcode == Opcode.Halt:
-            return self.halt()
+    def op_change_ptr_offset(self, instr: Instruction):
+        self.ptroffset += self.load(instr, 0)
 
-        else:
-            raise Exception(f"Illegal opcode {instr.opcode}. System on fire.")
+    def op_halt(self, instr: Instruction):
+        return self.halt()
 
     def step(self, steps=1):
         self.ptr += steps
 
     def readbuffer(self):
-        def get_input():
-            print("Enter a value: ", end="")
-            return input()
-
-        data = self.inbuffer.pop() if self.inbuffer else get_input()
-        return int(data)
+        return int(self.inbuffer.popleft())
 
     def halt(self):
-        if self.outbuffer:
-            return self.outbuffer[-1]
+        if self.lastout is not None:
+            return self.lastout
         return self.data[0]
+
+
+class Snapshot:
+    """
+    Frozen VM state. Forks start from it without copying memory.
+    """
+    vm: Intcoder
+
+    def __init__(self, vm: Intcoder):
+        self.vm = vm
+
+    def fork(self) -> Intcoder:
+        return self.vm.fork()
+
+
+HANDLERS = {
+    Opcode.Add: Intcoder.op_add,
+    Opcode.Mul: Intcoder.op_mul,
+    Opcode.Input: Intcoder.op_input,
+    Opcode.Output: Intcoder.op_output,
+    Opcode.JumpIfTrue: Intcoder.op_jump_if_true,
+    Opcode.JumpIfFalse: Intcoder.op_jump_if_false,
+    Opcode.LessThan: Intcoder.op_less_than,
+    Opcode.Equals: Intcoder.op_equals,
+    Opcode.ChangePtrOffset: Intcoder.op_change_ptr_offset,
+    Opcode.Halt: Intcoder.op_halt,
+}
+
+
+def test():
+    # self-modifying code: the loop rewrites the operand of an already decoded Output
+    coder = Intcoder([104, 0, 101, 1, 1, 1, 1007, 1, 3, 20, 1005, 20, 0, 99])
+    coder.run()
+    assert coder.outbuffer == [0, 1, 2]
+
+    # memory pages are allocated on demand and widen to objects on 64-bit overflow
+    mem = Mem([1, 2, 3])
+    mem[10000] = 1125899906842624 ** 2
+    assert mem[10000] == 1125899906842624 ** 2 and mem[5000] == 0
+    assert len(mem) == 10001
+    assert mem[:3] == [1, 2, 3]
+
+    # forks share memory with the parent and only keep their own writes
+    parent = Intcoder([3, 9, 1, 9, 10, 9, 4, 9, 99, 0, 100])
+    parent.run_until_input()
+    snapshot = parent.snapshot()
+    results = []
+    for x in range(3):
+        child = snapshot.fork()
+        child.inbuffer.append(x)
+        results.append(child.run())
+        assert len(child.data.pages) == 1
+    assert results == [100, 101, 102]
+    assert parent.data[9] == 0 and parent.ptr == 0
+    # decoded code is shared until a side decodes or invalidates something
+    child = parent.fork()
+    assert child.decoded is parent.decoded and child.codecells is parent.codecells
+    child.run([5])
+    assert child.decoded is not parent.decoded and 2 in child.decoded and 2 not in parent.decoded
+
+    # input is read in order from lists, shared deques, iterators and callables
+    echo = [3, 9, 4, 9, 1105, 1, 0, 99, 0, 0]
+    coder = Intcoder(echo, [1, 2])
+    assert coder.run_until_input().result == RunResult.NeedInput and coder.outbuffer == [1, 2]
+    feed = deque([3])
+    coder.inbuffer = feed
+    coder.run_until_input()
+    feed.append(4)
+    coder.run_until_input()
+    assert coder.outbuffer == [1, 2, 3, 4]
+    assert list(Intcoder(echo, iter(range(5))).outputs(2)) == [(0, 1), (2, 3)]
+    assert list(islice(Intcoder(echo, lambda: 7).outputs(), 3)) == [7, 7, 7]
+
+    # a bounded output buffer pauses the VM until it is drained
+    coder = Intcoder(echo, range(10))
+    coder.outlimit = 4
+    assert coder.run_until_input().result == RunResult.OutputFull and coder.outbuffer == [0, 1, 2, 3]
+    assert coder.run_until_input().result == RunResult.OutputFull
+    coder.outbuffer.clear()
+    coder.run_until_input()
+    assert coder.outbuffer == [4, 5, 6, 7]
+    # also for a plain run, and for a sink, where each run hands over at most outlimit values
+    coder = Intcoder([104, 1, 104, 2, 104, 3, 99])
+    coder.outlimit = 2
+    assert coder.run() == (RunResult.OutputFull, 0) and coder.outbuffer == [1, 2]
+    received = []
+    coder = Intcoder(echo, range(5))
+    coder.outlimit, coder.sink = 2, received.append
+    assert coder.run_until_input().result == RunResult.OutputFull and received == [0, 1]
+    assert coder.run().result == RunResult.OutputFull and received == [0, 1, 2, 3]
+    assert coder.run_until_input().result == RunResult.NeedInput and received == [0, 1, 2, 3, 4]
+
+    # input that isn't there raises instead of blocking, and leaves the VM on the input instruction
+    coder = Intcoder([3, 5, 4, 5, 99, 0])
+    try:
+        coder.run()
+        assert False
+    except RuntimeError:
+        assert coder.ptr == 0
+    assert coder.run([9]) == 9
+
+    # budgets pause a runaway program and let it carry on later, output counts stop after n values
+    spin = Intcoder([1105, 1, 0])
+    assert spin.run(max_steps=1000) == (RunResult.OutOfSteps, 0) and spin.ptr == 0
+    coder = Intcoder(echo, range(10))
+    assert coder.run(max_outputs=3) == (RunResult.HasOutput, 2) and coder.outbuffer == [0, 1, 2]
+    assert coder.run(stop_on=StopOn.Output).output == 3
+    assert coder.run(stop_on=StopOn.Input, max_steps=7).result == RunResult.OutOfSteps
+    assert coder.run(stop_on=StopOn.Input).result == RunResult.NeedInput and coder.outbuffer[-1] == 9
+
+    # watchpoints see changes to their cells only, writes of the same value don't count
+    counter = [1101, 0, 0, 20, 1001, 20, 1, 20, 1001, 21, 0, 21, 1007, 20, 3, 22, 1005, 22, 4, 99] + [0] * 3
+    coder = Intcoder(counter)
+    watch = coder.watch(20)
+    seen = []
+    coder.watch(21, 23, lambda addr, old, new: seen.append((addr, new)))
+    coder.run()
+    assert watch.events == [(20, 0, 1), (20, 1, 2), (20, 2, 3)] and seen == [(22, 1), (22, 0)]
+    # unwatched cells stop trapping, unless they are code
+    coder.unwatch(watch)
+    assert 20 not in coder.watches and 20 not in coder.codecells
+    watch = coder.watch(4)
+    coder.unwatch(watch)
+    assert 4 not in coder.watches and 4 in coder.codecells
+    print("Intcoder tests passed.")
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,258 @@
+from typing import Dict, Hashable, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+from lib.intcoder import Intcoder, Mem
+
+MASK = (1 << 64) - 1
+# base of the output buffer's polynomial hash; odd, so it has an inverse mod 2**64
+BASE = 1000003
+BASE_INVERSE = pow(BASE, -1, 1 << 64)
+
+
+def cell_hash(addr: int, value: int) -> int:
+    return hash((addr, value))
+
+
+class HashedMem(Mem):
+    """
+    Mem with a running digest of how it differs from the image it was loaded with.
+    Each write adjusts the digest by the cell's old and new value, so it never rescans memory.
+    """
+    digest: int
+
+    def __init__(self, data):
+        self.digest = 0
+        super().__init__(data)
+
+    def __setitem__(self, key, value):
+        # own the page first, or Mem's first write to it would come back through here and count twice
+        self.touch(key)
+        self.digest = (self.digest + cell_hash(key, value) - cell_hash(key, self[key])) & MASK
+        Mem.__setitem__(self, key, value)
+
+    def fork(self) -> "HashedMem":
+        mem = HashedMem(())
+        mem.view = dict(self.share())
+        mem.size = self.size
+        mem.digest = self.digest
+        return mem
+
+
+class HashedOutput(list):
+    """
+    Output buffer with a running polynomial hash of what it holds. Appends and removals at either end,
+    the way hosts drain outputs, adjust the hash; anything else rehashes the buffer.
+    """
+    digest: int
+
+    def __init__(self, values: Iterable[int] = ()):
+        super().__init__()
+        self.digest = 0
+        self.extend(values)
+
+    def append(self, value: int):
+        super().append(value)
+        self.digest = (self.digest * BASE + hash(value)) & MASK
+
+    def extend(self, values: Iterable[int]):
+        for value in values:
+            self.append(value)
+
+    def __iadd__(self, values: Iterable[int]) -> "HashedOutput":
+        self.extend(values)
+        return self
+
+    def pop(self, index: int = -1) -> int:
+        size = len(self)
+        value = super().pop(index)
+        if index in (-1, size - 1):
+            self.digest = (self.digest - hash(value)) * BASE_INVERSE & MASK
+        elif index in (0, -size):
+            # the values after it keep their distance to the end, so their weights stay the same
+            self.digest = (self.digest - hash(value) * pow(BASE, size - 1, 1 << 64)) & MASK
+        else:
+            self.rehash()
+        return value
+
+    def __delitem__(self, key):
+        size = len(self)
+        if isinstance(key, slice) and key.start in (None, 0) and key.step in (None, 1):
+            removed = self[key]
+            for i, value in enumerate(removed):
+                self.digest = (self.digest - hash(value) * pow(BASE, size - 1 - i, 1 << 64)) & MASK
+            super().__delitem__(key)
+        else:
+            super().__delitem__(key)
+            self.rehash()
+
+    def clear(self):
+        super().clear()
+        self.digest = 0
+
+    def rehash(self):
+        values = list(self)
+        super().clear()
+        self.digest = 0
+        self.extend(values)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.rehash()
+
+    def insert(self, index: int, value: int):
+        super().insert(index, value)
+        self.rehash()
+
+    def remove(self, value: int):
+        super().remove(value)
+        self.rehash()
+
+
+class HashingIntcoder(Intcoder):
+    """
+    Intcoder that can fingerprint its whole state. Memory and pending output are hashed as they change,
+    so engines whose compiled code writes pages directly (BlockIntcoder) can't be used.
+    """
+    data: HashedMem
+    hashed_outbuffer: HashedOutput
+
+    def __init__(self, data, input_buffer=None):
+        super().__init__((), input_buffer)
+        self.data = HashedMem(data)
+
+    @property
+    def outbuffer(self) -> HashedOutput:
+        return self.hashed_outbuffer
+
+    @outbuffer.setter
+    def outbuffer(self, values: Iterable[int]):
+        self.hashed_outbuffer = values if isinstance(values, HashedOutput) else HashedOutput(values)
+
+    def fingerprint(self, host: Hashable = None) -> int:
+        outbuffer = self.outbuffer
+        return hash((self.data.digest, self.ptr, self.ptroffset, tuple(self.inbuffer), outbuffer.digest,
+                     len(outbuffer), self.lastout, host))
+
+
+class Cycle(NamedTuple):
+    start: int
+    length: int
+
+
+class CycleDetector:
+    """
+    Finds when a VM and its host come back to a state they were in at an earlier I/O boundary.
+    From then on everything repeats, so the host's running totals at any later boundary follow
+    from one pass through the cycle. Host state that decides what happens next goes in the
+    fingerprint; totals that only accumulate must stay out of it, or nothing ever repeats.
+    Fingerprints are 64-bit hashes, a collision would be taken for a cycle.
+    """
+    vm: HashingIntcoder
+    seen: Dict[int, int]
+    totals: List[Tuple[int, ...]]
+    cycle: Optional[Cycle]
+
+    def __init__(self, vm: HashingIntcoder):
+        self.vm = vm
+        self.seen = {}
+        self.totals = []
+        self.cycle = None
+
+    def boundary(self, host: Hashable, totals: Sequence[int]) -> Optional[Cycle]:
+        """
+        Record the state at the current I/O boundary. Returns the cycle once the state repeats.
+        """
+        index = len(self.totals)
+        self.totals.append(tuple(totals))
+        start = self.seen.setdefault(self.vm.fingerprint(host), index)
+        if start != index:
+            self.cycle = Cycle(start, index - start)
+        return self.cycle
+
+    def project(self, boundary: int) -> Tuple[int, ...]:
+        """
+        Host totals at any boundary, past the ones recorded by skipping whole cycles.
+        """
+        if boundary < len(self.totals):
+            return self.totals[boundary]
+        if self.cycle is None:
+            raise ValueError("no cycle detected")
+        start, length = self.cycle
+        cycles, rest = divmod(boundary - start, length)
+        first, base = self.totals[start], self.totals[start + rest]
+        per_cycle = [b - a for a, b in zip(first, self.totals[start + length])]
+        return tuple(x + cycles * d for x, d in zip(base, per_cycle))
+
+
+def test():
+    # a blinker that never halts: reads a step, outputs 1, 0, 0, 1, 1 over and over by rewriting its Output
+    code = [3, 30, 4, 40, 1001, 3, 1, 3, 1008, 3, 45, 31, 1006, 31, 0, 1101, 0, 40, 3, 1105, 1, 0]
+    code += [0] * (40 - len(code)) + [1, 0, 0, 1, 1]
+    vm = HashingIntcoder(code)
+    detector = CycleDetector(vm)
+    ones = 0
+    while detector.boundary(None, [ones]) is None:
+        vm.run([0], max_outputs=1)
+        ones += vm.outbuffer.pop()
+    assert detector.cycle.length == 5
+
+    # the same count by running every step
+    vm = HashingIntcoder(code)
+    expected = 0
+    for _ in range(1003):
+        vm.run([0], max_outputs=1)
+        expected += vm.outbuffer.pop()
+    assert detector.project(1003) == (expected,) == (601,)
+    assert detector.project(10 ** 12) == (6 * 10 ** 11,)
+
+    # boundaries past the recorded ones can't be projected before a cycle shows up
+    detector = CycleDetector(HashingIntcoder(code))
+    detector.boundary(None, [0])
+    try:
+        detector.project(10)
+        assert False
+    except ValueError:
+        pass
+
+    # the output hash only depends on what is waiting in the buffer, however it was drained
+    a, b = HashedOutput([7, 1, 2, 3]), HashedOutput()
+    a.pop(0)
+    a.append(4)
+    del a[:1]
+    a.pop()
+    b += [2, 3]
+    assert a == b and a.digest == b.digest
+    a.insert(0, 5)
+    a.remove(5)
+    assert a.digest == b.digest
+    vm = HashingIntcoder(code)
+    vm.run([0], max_outputs=1)
+    child = vm.fork()
+    vm.outbuffer.pop()
+    child.outbuffer.clear()
+    assert vm.fingerprint() == child.fingerprint()
+
+    # the digest only depends on what memory holds, not on how it got there
+    a, b = HashedMem([1, 2, 3]), HashedMem([1, 2, 3])
+    a[1] = 5
+    a[300] = 7
+    a[1] = 2
+    b[300] = 7
+    assert a.digest == b.digest != HashedMem([1, 2, 3]).digest
+    assert a.fork().digest == a.digest
+
+    # a value written and then put back leaves the digest where it was, on a fresh page and after a fork
+    a = HashedMem([1, 2, 3])
+    a[300] = 7
+    a[300] = 0
+    assert a.digest == 0
+    a[2] = 9
+    child = a.fork()
+    child[2] = 3
+    assert child.digest == 0
+    child[2] = 9
+    assert child.digest == a.digest
+    print("Cycle detection tests passed.")
+
+
+if __name__ == "__main__":
+    test()
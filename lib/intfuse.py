@@ -0,0 +1,281 @@
+import os
+import sys
+import time
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Set, Tuple, Type
+
+from lib.intbench import ROOT, WORKLOADS, profile_workload
+from lib.intcoder import OPCODES, Instruction, Intcoder, Opcode, ParamMode
+from lib.intimage import load_program
+from lib.intprofile import Profiler
+
+Signature = Tuple[Opcode, Tuple[ParamMode, ...]]
+Pattern = Tuple[Signature, ...]
+Handler = Callable[[Intcoder, Instruction], Optional[int]]
+
+MAX_FUSED = 3
+MAX_PATTERNS = 16
+
+# instructions that always fall through can lead a fused sequence, a conditional jump can only end one
+FALLTHROUGH = {Opcode.Add, Opcode.Mul, Opcode.LessThan, Opcode.Equals, Opcode.ChangePtrOffset}
+ENDS = FALLTHROUGH | {Opcode.JumpIfTrue, Opcode.JumpIfFalse}
+
+EXPRESSIONS = {
+    Opcode.Add: "{0} + {1}",
+    Opcode.Mul: "{0} * {1}",
+    Opcode.LessThan: "1 if {0} < {1} else 0",
+    Opcode.Equals: "1 if {0} == {1} else 0",
+}
+
+
+def signature(instr: Instruction) -> Signature:
+    return instr.opcode, instr.modes
+
+
+class FusedInstruction(Instruction):
+    """
+    Several instructions run by one handler. Only its start address maps to it,
+    so a jump into the middle of the sequence runs the plain instructions found there.
+    """
+    __slots__ = ("parts", "start")
+
+    parts: Tuple[Instruction, ...]
+    start: int
+
+    def __init__(self, parts: Tuple[Instruction, ...], handler: Handler, start: int):
+        self.opcode = parts[0].opcode
+        self.params = tuple(x for part in parts for x in part.params)
+        self.modes = tuple(x for part in parts for x in part.modes)
+        self.size = sum(x.size for x in parts)
+        self.handler = handler
+        self.parts = parts
+        self.start = start
+
+    def __repr__(self):
+        return " + ".join(repr(x) for x in self.parts)
+
+
+def operand(mode: ParamMode, k: int) -> str:
+    if mode == ParamMode.Immediate:
+        return f"p[{k}]"
+    if mode == ParamMode.Relative:
+        return f"data[vm.ptroffset + p[{k}]]"
+    return f"data[p[{k}]]"
+
+
+def address(mode: ParamMode, k: int) -> str:
+    return f"vm.ptroffset + p[{k}]" if mode == ParamMode.Relative else f"p[{k}]"
+
+
+def compile_pattern(pattern: Pattern) -> Handler:
+    size = sum(len(modes) + 1 for _, modes in pattern)
+    lines = ["def fused(vm, instr):", "    p = instr.params", "    data = vm.data", f"    start = vm.ptr - {size}"]
+    k, offset = 0, 0
+    for i, (opcode, modes) in enumerate(pattern):
+        offset += len(modes) + 1
+        if opcode in EXPRESSIONS:
+            expr = EXPRESSIONS[opcode].format(operand(modes[0], k), operand(modes[1], k + 1))
+            lines += [f"    addr = {address(modes[2], k + 2)}", f"    vm.putaddr(addr, {expr})"]
+            if i < len(pattern) - 1:
+                # the sequence rewrote itself: carry on with the plain instructions after this one
+                lines += [f"    if start <= addr < start + {size}:", f"        vm.ptr = start + {offset}",
+                          "        return None"]
+        elif opcode == Opcode.ChangePtrOffset:
+            lines.append(f"    vm.ptroffset += {operand(modes[0], k)}")
+        else:
+            test = "!=" if opcode == Opcode.JumpIfTrue else "=="
+            lines += [f"    if {operand(modes[0], k)} {test} 0:", f"        vm.ptr = {operand(modes[1], k + 1)}"]
+        k += len(modes)
+    namespace = {}
+    exec("\n".join(lines), namespace)
+    return namespace["fused"]
+
+
+class Fusions:
+    """
+    Fused handlers for a set of instruction sequences, looked up by the sequence's first instruction.
+    """
+    handlers: Dict[Pattern, Handler]
+    by_first: Dict[Signature, List[Pattern]]
+
+    def __init__(self, patterns: List[Pattern] = ()):
+        self.handlers = {}
+        self.by_first = {}
+        for pattern in patterns:
+            self.handlers[pattern] = compile_pattern(pattern)
+            self.by_first.setdefault(pattern[0], []).append(pattern)
+        for candidates in self.by_first.values():
+            candidates.sort(key=len, reverse=True)
+
+    def __len__(self):
+        return len(self.handlers)
+
+
+def ngrams(profiler: Profiler, length: int = MAX_FUSED) -> Counter:
+    """
+    How often each executed sequence of up to length instructions ran from its start to its end.
+    Every instruction but the last falls through, so that is the hit count of the first one.
+    """
+    counts = Counter()
+    for addr, hits in profiler.hits.items():
+        parts = []
+        while len(parts) < length and addr in profiler.instrs:
+            instr = profiler.instrs[addr]
+            if isinstance(instr, FusedInstruction) or instr.opcode not in ENDS:
+                break
+            parts.append(signature(instr))
+            if len(parts) > 1:
+                counts[tuple(parts)] += hits
+            if instr.opcode not in FALLTHROUGH:
+                break
+            addr += instr.size
+    return counts
+
+
+def learn(profiler: Profiler, top: int = MAX_PATTERNS, length: int = MAX_FUSED) -> Fusions:
+    # rank by dispatches saved, a sequence of n instructions saves n - 1 each time
+    counts = ngrams(profiler, length)
+    ranked = sorted(counts, key=lambda x: counts[x] * (len(x) - 1), reverse=True)
+    return Fusions(ranked[:top])
+
+
+class FusedIntcoder(Intcoder):
+    """
+    Intcoder that decodes the start of a known hot sequence into one fused instruction.
+    Code the program has rewritten is never fused again, it would only be decoded over and over.
+    Opt-in only: matching patterns makes decoding slower, which costs more than the saved dispatches
+    unless hot loops run many times. Day 9 gains, day 11 breaks about even, days 2, 5, 7 and 13 run slower.
+    """
+    fusions: Fusions = Fusions()
+    fusedcells: Dict[int, List[int]]
+    volatile: Set[int]
+
+    def __init__(self, data, input_buffer=None):
+        super().__init__(data, input_buffer)
+        self.fusedcells = {}
+        self.volatile = set()
+
+    def fork(self) -> "FusedIntcoder":
+        child = super().fork()
+        child.fusedcells = {k: list(v) for k, v in self.fusedcells.items()}
+        child.volatile = set(self.volatile)
+        return child
+
+    def decode(self, addr: int) -> Instruction:
+        instr = super().decode(addr)
+        for pattern in self.fusions.by_first.get(signature(instr), ()):
+            parts = self.match(addr, pattern)
+            if parts:
+                fused = self.decoded[addr] = FusedInstruction(parts, self.fusions.handlers[pattern], addr)
+                for x in range(addr, addr + fused.size):
+                    self.codecells.add(x)
+                    self.fusedcells.setdefault(x, []).append(addr)
+                return fused
+        return instr
+
+    def match(self, addr: int, pattern: Pattern) -> Optional[Tuple[Instruction, ...]]:
+        parts = []
+        for expected in pattern:
+            raw = self.data[addr]
+            if raw < 0 or raw % 100 not in OPCODES:
+                return None
+            instr = self.decoded.get(addr) or super().decode(addr)
+            if isinstance(instr, FusedInstruction):
+                instr = instr.parts[0]
+            if signature(instr) != expected or not self.volatile.isdisjoint(range(addr, addr + instr.size)):
+                return None
+            parts.append(instr)
+            addr += instr.size
+        return tuple(parts)
+
+    def invalidate(self, addr: int):
+        super().invalidate(addr)
+        self.volatile.add(addr)
+        for start in self.fusedcells.pop(addr, ()):
+            if isinstance(self.decoded.get(start), FusedInstruction):
+                del self.decoded[start]
+
+
+def fused_engine(fusions: Fusions) -> Type[FusedIntcoder]:
+    return type("FusedIntcoder", (FusedIntcoder,), {"fusions": fusions})
+
+
+def report(top: int = MAX_PATTERNS) -> List[dict]:
+    # each workload is profiled, fused from its own profile, then counted and timed again
+    rows = []
+    for workload in WORKLOADS:
+        program = load_program(os.path.join(ROOT, workload.filename))
+        profile = profile_workload(workload, program)
+        engine = fused_engine(learn(profile, top))
+        dispatches = profile_workload(workload, program, engine).dispatches
+        timings = []
+        for x in (Intcoder, engine):
+            start = time.perf_counter()
+            answer = workload.run(x, program)
+            timings.append(time.perf_counter() - start)
+        rows.append({
+            "workload": workload.name,
+            "instructions": profile.instructions,
+            "dispatches": dispatches,
+            "saved": 1 - dispatches / profile.instructions,
+            "plain": timings[0],
+            "fused": timings[1],
+            "correct": tuple(answer) == workload.expected,
+            "net_loss": timings[1] > timings[0],
+        })
+    return rows
+
+
+def main(args: List[str]):
+    # python -m lib.intfuse [top]
+    rows = report(int(args[0]) if args else MAX_PATTERNS)
+    print(f"{'':>6} {'instructions':>12} {'dispatches':>12} {'saved':>7} {'plain':>10} {'fused':>10}")
+    for x in rows:
+        print(f"{x['workload']:>6} {x['instructions']:12d} {x['dispatches']:12d} {100 * x['saved']:6.1f}% "
+              f"{x['plain'] * 1000:7.1f} ms {x['fused'] * 1000:7.1f} ms{'  net loss' if x['net_loss'] else ''}"
+              f"{'' if x['correct'] else '  WRONG'}")
+
+
+def test():
+    # count cell 20 up to 100: Add, Equals and JumpIfFalse run as one dispatch
+    code = [1001, 20, 1, 20, 1008, 20, 100, 21, 1006, 21, 0, 4, 20, 99]
+    vm = Intcoder(code)
+    with Profiler(vm) as profile:
+        vm.run()
+    fusions = learn(profile, top=1)
+    assert len(fusions.by_first[signature(vm.decoded[0])][0]) == 3
+
+    vm = fused_engine(fusions)(code)
+    with Profiler(vm) as fused_profile:
+        assert vm.run() == 100
+    assert fused_profile.dispatches == profile.instructions - 2 * 100
+    assert fused_profile.opcodes == profile.opcodes and fused_profile.writes == profile.writes
+
+    # a fused relative base change: the reads after it are counted where they happen
+    stack = [109, 1, 201, 0, 30, 30, 1001, 31, 1, 31, 1008, 31, 5, 32, 1006, 32, 0, 4, 30, 99]
+    vm = Intcoder(stack)
+    with Profiler(vm) as profile:
+        vm.run()
+    vm = fused_engine(learn(profile))(stack)
+    with Profiler(vm) as fused_profile:
+        assert vm.run() == 1 + 201 + 0 + 30 + 30
+    assert isinstance(vm.decoded[0], FusedInstruction) and fused_profile.reads == profile.reads
+
+    # the same loop entered at its Equals: the first pass runs the plain instructions from there
+    entry = [1105, 1, 7, 1001, 23, 1, 23, 1008, 23, 100, 24, 1006, 24, 3, 4, 23, 99] + [0] * 8
+    assert fused_engine(fusions)(entry).run() == 100
+
+    # a sequence that rewrites its own jump target carries on with the plain instructions
+    selfmod = [1101, 0, 16, 10, 1108, 1, 1, 12, 1005, 12, 13, 99, 0, 104, 1, 99, 104, 2, 99]
+    vm = Intcoder(selfmod)
+    with Profiler(vm) as profile:
+        assert vm.run() == 2
+    assert fused_engine(learn(profile, top=1))(selfmod).run() == 2
+    print("Fusion tests passed.")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(sys.argv[1:])
+    else:
+        test()
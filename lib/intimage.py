@@ -0,0 +1,110 @@
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from typing import List, Optional
+
+from lib.utils import readnumbers_csv
+
+MAGIC = b"ICIM"
+IMAGE_VERSION = 2
+
+# magic, version, csv size, csv mtime_ns, cell count, wide cell count
+HEADER = struct.Struct("<4sHqqII")
+# index and byte length of a cell that does not fit in int64
+WIDE = struct.Struct("<II")
+
+
+def image_path(csv_path: str) -> str:
+    head, tail = os.path.split(os.path.abspath(csv_path))
+    return os.path.join(head, "__pycache__", f"{tail}.v{IMAGE_VERSION}.img")
+
+
+def pack_image(cells: List[int], size: int, mtime_ns: int) -> bytes:
+    packed = array("q")
+    wide = []
+    for i, x in enumerate(cells):
+        if -2 ** 63 <= x < 2 ** 63:
+            packed.append(x)
+        else:
+            packed.append(0)
+            raw = x.to_bytes((x.bit_length() + 8) // 8, "little", signed=True)
+            wide.append(WIDE.pack(i, len(raw)) + raw)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return HEADER.pack(MAGIC, IMAGE_VERSION, size, mtime_ns, len(cells), len(wide)) + packed.tobytes() + b"".join(wide)
+
+
+def unpack_image(blob, size: int, mtime_ns: int) -> Optional[List[int]]:
+    if len(blob) < HEADER.size:
+        return None
+    magic, version, csv_size, csv_mtime_ns, count, wide_count = HEADER.unpack_from(blob, 0)
+    if (magic, version, csv_size, csv_mtime_ns) != (MAGIC, IMAGE_VERSION, size, mtime_ns):
+        return None
+    offset = HEADER.size
+    cells = array("q")
+    cells.frombytes(blob[offset:offset + count * 8])
+    if sys.byteorder == "big":
+        cells.byteswap()
+    cells = cells.tolist()
+    offset += count * 8
+    for _ in range(wide_count):
+        index, length = WIDE.unpack_from(blob, offset)
+        offset += WIDE.size
+        cells[index] = int.from_bytes(blob[offset:offset + length], "little", signed=True)
+        offset += length
+    return cells
+
+
+def load_program(csv_path: str) -> List[int]:
+    """
+    First program in an Intcode CSV, read from a binary image next to it when one is up to date.
+    The image is written on first load and rewritten whenever the CSV's size or mtime changes.
+    """
+    stat = os.stat(csv_path)
+    path = image_path(csv_path)
+    try:
+        with open(path, "rb") as infile, mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            cells = unpack_image(mapped, stat.st_size, stat.st_mtime_ns)
+        if cells is not None:
+            return cells
+    except (OSError, ValueError, struct.error):
+        pass
+
+    cells = readnumbers_csv(csv_path)[0]
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as outfile:
+            outfile.write(pack_image(cells, stat.st_size, stat.st_mtime_ns))
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+    return cells
+
+
+def test():
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = os.path.join(tmp, "prog.csv")
+        with open(csv_path, "w") as outfile:
+            outfile.write(f"1,2,-3,{2 ** 70},{-2 ** 64},{-7 ** 2000},99\n")
+        assert load_program(csv_path) == [1, 2, -3, 2 ** 70, -2 ** 64, -7 ** 2000, 99]
+        assert os.path.exists(image_path(csv_path))
+        assert load_program(csv_path) == [1, 2, -3, 2 ** 70, -2 ** 64, -7 ** 2000, 99]
+
+        # an edited CSV makes the stale image get rebuilt
+        with open(csv_path, "w") as outfile:
+            outfile.write("104,7,99\n")
+        os.utime(csv_path, ns=(0, 0))
+        assert load_program(csv_path) == [104, 7, 99]
+
+        with open(image_path(csv_path), "wb") as outfile:
+            outfile.write(b"ICIM")
+        assert load_program(csv_path) == [104, 7, 99]
+    print("Image tests passed.")
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,142 @@
+import hashlib
+import os
+import shelve
+import tempfile
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional, Sequence, Tuple, Type, Union
+
+from lib.intcoder import PAGE_BITS, Intcoder, RunResult, StopOn
+
+MAX_ENTRIES = 4096
+MEMO_VERSION = 1
+
+Key = Tuple[Tuple[Tuple[int, int], ...], Tuple[int, ...]]
+
+
+class Outcome(NamedTuple):
+    result: RunResult
+    value: int
+    outputs: Tuple[int, ...]
+    # final state, shared by every caller that gets this outcome: fork it before running it on
+    vm: Intcoder
+
+
+class RunCache:
+    """
+    Memoized runs of one program. A run only depends on the memory patches and the input it gets,
+    so its outcome is kept under those in an LRU, and with a path also in a store on disk.
+    Runs stop on halt or when the input runs out, both are cached.
+    """
+    template: Intcoder
+    key: str
+    entries: "OrderedDict[Key, Outcome]"
+    maxsize: int
+    store: Optional[shelve.Shelf]
+    hits: int
+    misses: int
+
+    def __init__(self, program: Union[Sequence[int], Intcoder], engine: Type[Intcoder] = Intcoder,
+                 maxsize: int = MAX_ENTRIES, path: str = None):
+        self.template = program if isinstance(program, Intcoder) else engine(program)
+        self.key = hashlib.sha1(",".join(str(x) for x in self.template.data).encode()).hexdigest()
+        self.entries = OrderedDict()
+        self.maxsize = maxsize
+        self.store = shelve.open(path) if path else None
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self) -> "RunCache":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+    def run(self, inputs: Sequence[int] = (), patches: Dict[int, int] = None) -> Outcome:
+        key = (tuple(sorted(patches.items())) if patches else (), tuple(inputs))
+        outcome = self.entries.get(key)
+        if outcome is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return outcome
+
+        stored = self.store.get(self.store_key(key)) if self.store is not None else None
+        if stored is not None:
+            self.hits += 1
+            outcome = self.rebuild(key, stored)
+        else:
+            self.misses += 1
+            outcome = self.execute(key)
+            if self.store is not None:
+                self.store[self.store_key(key)] = self.flatten(outcome)
+
+        self.entries[key] = outcome
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return outcome
+
+    def store_key(self, key: Key) -> str:
+        return f"v{MEMO_VERSION}:{self.key}:{key}"
+
+    def start(self, key: Key) -> Intcoder:
+        vm = self.template.fork()
+        for addr, value in key[0]:
+            vm.putaddr(addr, value)
+        return vm
+
+    def execute(self, key: Key) -> Outcome:
+        vm = self.start(key)
+        rs = vm.run(list(key[1]), stop_on=StopOn.Input)
+        return Outcome(rs.result, rs.output, tuple(vm.outbuffer), vm)
+
+    def flatten(self, outcome: Outcome) -> tuple:
+        # memory goes to disk as the cells that differ from the program, only pages the run wrote can differ
+        vm, image = outcome.vm, self.template.data
+        changes = []
+        for pagenum, page in vm.data.pages.items():
+            base = pagenum << PAGE_BITS
+            changes.extend((base + i, x) for i, x in enumerate(page) if x != image[base + i])
+        return outcome.result.value, outcome.value, outcome.outputs, vm.ptr, vm.ptroffset, tuple(changes)
+
+    def rebuild(self, key: Key, stored: tuple) -> Outcome:
+        result, value, outputs, ptr, ptroffset, changes = stored
+        vm = self.start(key)
+        for addr, x in changes:
+            vm.putaddr(addr, x)
+        vm.ptr, vm.ptroffset = ptr, ptroffset
+        vm.outbuffer = list(outputs)
+        vm.lastout = outputs[-1] if outputs else None
+        return Outcome(RunResult(result), value, outputs, vm)
+
+
+def test():
+    # adds the two inputs and stores the sum in cell 0
+    code = [3, 11, 3, 12, 1, 11, 12, 0, 4, 0, 99, 0, 0]
+    memo = RunCache(code, maxsize=2)
+    assert memo.run([1, 2]).value == 3
+    assert memo.run([1, 2]).outputs == (3,) and (memo.hits, memo.misses) == (1, 1)
+    assert memo.run([1, 2]).vm.data[0] == 3
+
+    # patches are part of the key, and the least recently used outcome goes first
+    assert memo.run([1, 2], patches={9: 12}).value == 2
+    assert memo.run([5]).result == RunResult.NeedInput
+    assert len(memo.entries) == 2 and (memo.entries.popitem()[0], memo.misses) == (((), (5,)), 3)
+
+    # the store on disk outlives the process, and outcomes come back with their final state
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "memo")
+        with RunCache(code, path=path) as memo:
+            first = memo.run([20, 22])
+        with RunCache(code, path=path) as memo:
+            again = memo.run([20, 22])
+            assert (memo.hits, memo.misses) == (1, 0)
+        assert again[:3] == first[:3] and again.vm.data == first.vm.data and again.vm.ptr == first.vm.ptr
+    print("RunCache tests passed.")
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,305 @@
+import base64
+import json
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+from collections import deque
+from multiprocessing import Process
+from typing import Deque, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Set, Tuple, Type
+
+from lib.intcheckpoint import checkpoint, image_hash
+from lib.intcoder import Intcoder, RunResult, Snapshot, StopOn
+from lib.intsweep import CONTEXT, SweepJob
+
+MAX_RETRIES = 3
+JOB_TIMEOUT = 60.0
+POLL_INTERVAL = 0.1
+
+LENGTH = struct.Struct(">I")
+
+Address = Tuple[str, int]
+
+
+class JobResult(NamedTuple):
+    index: int
+    job: SweepJob
+    # halt value, or None when the job ran out of input
+    value: Optional[int]
+    outputs: List[int]
+    # intcheckpoint blob of the final state, restore it against the program
+    state: bytes
+
+
+def send(sock: socket.socket, message: dict):
+    payload = json.dumps(message).encode()
+    sock.sendall(LENGTH.pack(len(payload)) + payload)
+
+
+def receive(sock: socket.socket) -> Optional[dict]:
+    header = receive_exactly(sock, LENGTH.size)
+    if header is None:
+        return None
+    payload = receive_exactly(sock, LENGTH.unpack(header)[0])
+    return json.loads(payload) if payload is not None else None
+
+
+def receive_exactly(sock: socket.socket, size: int) -> Optional[bytes]:
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+class Coordinator:
+    """
+    Hands out Intcode jobs to workers that connect over TCP and pull them one at a time.
+    Each program image is sent once per worker connection, jobs refer to it by hash.
+    A job whose worker disconnects or takes longer than timeout goes back in the queue,
+    until it has failed on retries workers.
+    """
+    images: Dict[str, List[int]]
+    jobs: Dict[int, Tuple[str, SweepJob]]
+    pending: Deque[int]
+    assigned: Dict[int, float]
+    attempts: Dict[int, int]
+    finished: Deque[JobResult]
+    completed: Set[int]
+    failed: Dict[int, str]
+    retries: int
+    timeout: float
+    images_sent: int
+    closing: bool
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, retries: int = MAX_RETRIES,
+                 timeout: float = JOB_TIMEOUT):
+        self.images = {}
+        self.jobs = {}
+        self.pending = deque()
+        self.assigned = {}
+        self.attempts = {}
+        self.finished = deque()
+        self.completed = set()
+        self.failed = {}
+        self.retries = retries
+        self.timeout = timeout
+        self.images_sent = 0
+        self.closing = False
+        self.condition = threading.Condition()
+
+        coordinator = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                coordinator.serve(self.request)
+
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def __enter__(self) -> "Coordinator":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def address(self) -> Address:
+        return self.server.server_address[:2]
+
+    def close(self):
+        with self.condition:
+            self.closing = True
+            self.condition.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def submit(self, program: Sequence[int], job: SweepJob) -> int:
+        key = image_hash(program).hex()
+        with self.condition:
+            self.images.setdefault(key, list(program))
+            index = len(self.jobs)
+            self.jobs[index] = (key, job)
+            self.attempts[index] = 0
+            self.pending.append(index)
+            self.condition.notify_all()
+        return index
+
+    def results(self) -> Iterator[JobResult]:
+        """
+        Results of every submitted job as they complete.
+        """
+        while True:
+            with self.condition:
+                while not self.finished and not self.failed and len(self.completed) < len(self.jobs):
+                    self.condition.wait(POLL_INTERVAL)
+                    self.expire()
+                if self.failed:
+                    index, reason = next(iter(self.failed.items()))
+                    raise RuntimeError(f"Job {index} failed {self.attempts[index]} times: {reason}")
+                if not self.finished:
+                    return
+                result = self.finished.popleft()
+            yield result
+
+    def run(self, program: Sequence[int], jobs: Iterable[SweepJob]) -> List[JobResult]:
+        first = len(self.jobs)
+        for job in jobs:
+            self.submit(program, job)
+        return sorted((x for x in self.results() if x.index >= first), key=lambda x: x.index)
+
+    def expire(self):
+        now = time.monotonic()
+        for index, deadline in list(self.assigned.items()):
+            if deadline < now:
+                self.retry(index, "timed out")
+
+    def retry(self, index: int, reason: str):
+        # called with the condition held
+        if self.assigned.pop(index, None) is None or index in self.completed:
+            return
+        if self.attempts[index] >= self.retries:
+            self.failed[index] = reason
+        else:
+            self.pending.append(index)
+        self.condition.notify_all()
+
+    def take(self) -> Optional[int]:
+        with self.condition:
+            while not self.pending and not self.closing:
+                self.condition.wait(POLL_INTERVAL)
+                self.expire()
+            if self.closing:
+                return None
+            index = self.pending.popleft()
+            self.attempts[index] += 1
+            self.assigned[index] = time.monotonic() + self.timeout
+            return index
+
+    def complete(self, message: dict):
+        index = message["id"]
+        with self.condition:
+            if index in self.completed:
+                return
+            self.assigned.pop(index, None)
+            self.completed.add(index)
+            self.finished.append(JobResult(index, self.jobs[index][1], message["value"], message["outputs"],
+                                           base64.b64decode(message["state"])))
+            self.condition.notify_all()
+
+    def serve(self, sock: socket.socket):
+        sent = set()
+        current = None
+        try:
+            while True:
+                message = receive(sock)
+                if message is None:
+                    return
+                if message["op"] == "result":
+                    self.complete(message)
+                    current = None
+
+                current = self.take()
+                if current is None:
+                    send(sock, {"op": "done"})
+                    return
+                key, job = self.jobs[current]
+                reply = {"op": "job", "id": current, "image": key, "patches": list(job.patches.items()),
+                         "inputs": list(job.inputs)}
+                if key not in sent:
+                    reply["program"] = self.images[key]
+                    sent.add(key)
+                    self.images_sent += 1
+                send(sock, reply)
+        except (OSError, ValueError):
+            pass
+        finally:
+            if current is not None:
+                with self.condition:
+                    self.retry(current, "worker disconnected")
+
+
+def run_worker(address: Address, engine: Type[Intcoder] = Intcoder):
+    """
+    Pull jobs from a coordinator until it says it is done. Programs are kept by hash.
+    """
+    images: Dict[str, Snapshot] = {}
+    with socket.create_connection(address) as sock:
+        send(sock, {"op": "get"})
+        while True:
+            message = receive(sock)
+            if message is None or message["op"] == "done":
+                return
+            if "program" in message:
+                images[message["image"]] = engine(message["program"]).snapshot()
+            snapshot = images[message["image"]]
+            vm = snapshot.fork()
+            for addr, val in message["patches"]:
+                vm.putaddr(addr, val)
+            # a job only gets the input it came with, running out of it ends the job
+            rs = vm.run(message["inputs"], stop_on=StopOn.Input)
+            send(sock, {
+                "op": "result",
+                "id": message["id"],
+                "value": rs.output if rs.result == RunResult.Halted else None,
+                "outputs": vm.outbuffer,
+                "state": base64.b64encode(checkpoint(vm, snapshot.vm)).decode(),
+            })
+
+
+def start_workers(address: Address, count: int) -> List[Process]:
+    workers = [CONTEXT.Process(target=run_worker, args=(address,), daemon=True) for _ in range(count)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+def main(args: List[str]):
+    # python -m lib.intnet worker 10.0.0.5:7019
+    host, port = args[1].rsplit(":", 1)
+    run_worker((host, int(port)))
+
+
+def test():
+    from lib.intcheckpoint import restore
+
+    # day 5 comparison program, one job per input
+    code = [3, 9, 8, 9, 10, 9, 4, 9, 99, -1, 8]
+    with Coordinator(timeout=5.0) as coordinator:
+        # a worker that takes a job and dies with it: the job goes to another worker
+        flaky = socket.create_connection(coordinator.address)
+        send(flaky, {"op": "get"})
+        coordinator.submit(code, SweepJob({}, [8]))
+        assert receive(flaky)["op"] == "job"
+        flaky.close()
+
+        workers = start_workers(coordinator.address, 2)
+        results = coordinator.run(code, [SweepJob({}, [x]) for x in range(20)])
+        first = next(coordinator.results(), None)
+        assert first is None
+        assert [x.value for x in results] == [1 if x == 8 else 0 for x in range(20)]
+        assert coordinator.attempts[0] == 2 and 0 in coordinator.completed
+        assert coordinator.images_sent <= 3
+        assert restore(results[8].state, code).data[9] == 1
+
+        # patches and jobs that stop for want of input
+        results = coordinator.run([1101, 0, 5, 0, 3, 0, 99], [SweepJob({1: 7}, [])])
+        assert results[0].value is None and restore(results[0].state, [1101, 0, 5, 0, 3, 0, 99]).data[0] == 12
+    for worker in workers:
+        worker.join(5)
+        assert not worker.is_alive()
+    print("Worker pool tests passed.")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "worker":
+        main(sys.argv[1:])
+    else:
+        test()
@@ -0,0 +1,174 @@
+import os
+import sys
+import time
+from contextlib import contextmanager
+from copy import copy
+from typing import Dict, Iterable, Iterator, List, Sequence, Set, Type
+
+from lib.intblocks import BlockIntcoder
+from lib.intcoder import Intcoder, Mem
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class DirtyMem(Mem):
+    """
+    Mem that remembers every cell written to it.
+    """
+    dirty: Set[int]
+
+    def __init__(self, data):
+        self.dirty = set()
+        super().__init__(data)
+
+    def __setitem__(self, key, value):
+        self.dirty.add(key)
+        Mem.__setitem__(self, key, value)
+
+
+class VMPool:
+    """
+    Hands out VMs loaded with one program and takes them back for reuse.
+    Releasing a VM puts back only the cells its run wrote, so a reset costs as much as the run's writes,
+    not the program's length. Decoded instructions survive unless their code was written to.
+    Buffers are cleared in place: copy outbuffer before releasing the VM.
+    The engine has to write memory through Mem, so BlockIntcoder, whose compiled blocks bypass it, is refused.
+    """
+    image: List[int]
+    engine: Type[Intcoder]
+    free: List[Intcoder]
+    created: int
+
+    def __init__(self, program: Sequence[int], engine: Type[Intcoder] = Intcoder):
+        if issubclass(engine, BlockIntcoder):
+            raise ValueError(f"{engine.__name__} writes memory behind DirtyMem's back and can't be pooled")
+        self.image = list(program)
+        self.engine = engine
+        self.free = []
+        self.created = 0
+
+    def acquire(self, input_buffer: Iterable[int] = None) -> Intcoder:
+        if self.free:
+            vm = self.free.pop()
+        else:
+            vm = self.engine(())
+            vm.data = DirtyMem(self.image)
+            self.created += 1
+        if input_buffer is not None:
+            vm.inbuffer.extend(input_buffer)
+        return vm
+
+    def release(self, vm: Intcoder):
+        self.reset(vm)
+        self.free.append(vm)
+
+    def reset(self, vm: Intcoder):
+        data, image, size = vm.data, self.image, len(self.image)
+        for addr in data.dirty:
+            original = image[addr] if addr < size else 0
+            if data[addr] != original:
+                Mem.__setitem__(data, addr, original)
+                if addr in vm.codecells:
+                    vm.invalidate(addr)
+        data.dirty.clear()
+        vm.ptr = 0
+        vm.ptroffset = 0
+        vm.inport.clear()
+        vm.inport.source = None
+        vm.outbuffer.clear()
+        vm.outlimit = None
+        vm.sink = None
+        vm.lastout = None
+
+    @contextmanager
+    def borrow(self, input_buffer: Iterable[int] = None) -> Iterator[Intcoder]:
+        vm = self.acquire(input_buffer)
+        try:
+            yield vm
+        finally:
+            self.release(vm)
+
+    def run(self, input_buffer: Iterable[int] = (), patches: Dict[int, int] = None) -> int:
+        with self.borrow(input_buffer) as vm:
+            for addr, val in (patches or {}).items():
+                vm.putaddr(addr, val)
+            return vm.run()
+
+
+def benchmark(program: Sequence[int], runs: int) -> Dict[str, float]:
+    # day 2 style grid: patch noun and verb, run to halt
+    grid = [{1: x // 100, 2: x % 100} for x in range(runs)]
+    timings = {}
+
+    start = time.perf_counter()
+    for patches in grid:
+        ram = copy(program)
+        ram[1], ram[2] = patches[1], patches[2]
+        Intcoder(ram).run()
+    timings["construct"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    snapshot = Intcoder(program).snapshot()
+    for patches in grid:
+        vm = snapshot.fork()
+        for addr, val in patches.items():
+            vm.putaddr(addr, val)
+        vm.run()
+    timings["fork"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pool = VMPool(program)
+    for patches in grid:
+        pool.run(patches=patches)
+    timings["pool"] = time.perf_counter() - start
+    return timings
+
+
+def main(args: List[str]):
+    # python -m lib.intpool [runs]
+    from lib.intimage import load_program
+
+    runs = int(args[0]) if args else 2000
+    for name, seconds in benchmark(load_program(os.path.join(ROOT, "day2.csv")), runs).items():
+        print(f"{name:>10} {seconds * 1000:8.1f} ms {runs / seconds:10.0f} runs/s")
+
+
+def test():
+    # day 5 comparison program: every run writes its input and result, nothing else
+    pool = VMPool([3, 9, 8, 9, 10, 9, 4, 9, 99, -1, 8])
+    assert [pool.run([x]) for x in (7, 8, 9)] == [0, 1, 0]
+    assert pool.created == 1 and pool.free[0].data == [3, 9, 8, 9, 10, 9, 4, 9, 99, -1, 8]
+
+    # self-modifying code and writes past the image are put back too
+    code = [104, 0, 101, 1, 1, 1, 1007, 1, 3, 20, 1005, 20, 0, 99]
+    pool = VMPool(code)
+    with pool.borrow() as vm:
+        vm.putaddr(30, 7)
+        vm.run()
+        assert vm.outbuffer == [0, 1, 2]
+    vm = pool.acquire()
+    assert vm.data == code and vm.data[30] == 0 and not vm.data.dirty
+    vm.run()
+    assert vm.outbuffer == [0, 1, 2]
+    pool.release(vm)
+
+    # patches go back too, and a second VM is only made while the first is out
+    pool = VMPool([1, 0, 0, 0, 99])
+    with pool.borrow():
+        assert pool.run(patches={1: 4}) == 100
+    assert pool.run() == 2 and pool.created == 2
+
+    # compiled blocks write pages directly, their writes would never be put back
+    try:
+        VMPool([1, 0, 0, 0, 99], BlockIntcoder)
+        assert False
+    except ValueError:
+        pass
+    print("Pool tests passed.")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(sys.argv[1:])
+    else:
+        test()
@@ -0,0 +1,222 @@
+import sys
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Type
+
+from lib.intcoder import Instruction, Intcoder, Opcode, ParamMode, ReturnVal, RunLimits, RunResult, StopOn
+from lib.intimage import load_program
+
+# operand each opcode writes to, every other non-immediate operand is a read
+WRITE_OPERANDS = {
+    Opcode.Add: 2,
+    Opcode.Mul: 2,
+    Opcode.Input: 0,
+    Opcode.LessThan: 2,
+    Opcode.Equals: 2,
+}
+
+
+class Profiler:
+    """
+    Opt-in profiler for one VM. While attached the VM runs a counting copy of the run loop,
+    so nothing is checked or counted once it is detached. Profiled VMs always interpret,
+    whatever engine they use otherwise. Forks of a profiled VM report into the same profiler.
+    An engine that runs several instructions in one dispatch (lib.intfuse) has each of them
+    counted, dispatches are counted apart.
+    """
+    vm: Intcoder
+    engine: Optional[Type[Intcoder]]
+    dispatches: int
+    opcodes: Counter
+    hits: Counter
+    instrs: Dict[int, Instruction]
+    reads: Counter
+    writes: Counter
+    elapsed: float
+    blocked: float
+    waiting: Optional[float]
+
+    def __init__(self, vm: Intcoder):
+        self.vm = vm
+        self.engine = None
+        self.dispatches = 0
+        self.opcodes = Counter()
+        self.hits = Counter()
+        self.instrs = {}
+        self.reads = Counter()
+        self.writes = Counter()
+        self.elapsed = 0.0
+        self.blocked = 0.0
+        self.waiting = None
+
+    def __enter__(self) -> "Profiler":
+        self.attach()
+        return self
+
+    def __exit__(self, *exc):
+        self.detach()
+
+    def attach(self):
+        self.engine = type(self.vm)
+        self.vm.profiler = self
+        self.vm.__class__ = profiled(self.engine)
+
+    def detach(self):
+        self.vm.__class__ = self.engine
+        del self.vm.profiler
+
+    @property
+    def instructions(self) -> int:
+        return sum(self.opcodes.values())
+
+    def count(self, vm: Intcoder, instr: Instruction):
+        self.hits[vm.ptr] += 1
+        self.dispatches += 1
+        self.instrs[vm.ptr] = instr
+        # counted before the dispatch runs, so a part after a relative base change needs the base it will see
+        ptroffset = vm.ptroffset
+        for part in getattr(instr, "parts", (instr,)):
+            self.opcodes[part.opcode] += 1
+            written = WRITE_OPERANDS.get(part.opcode)
+            for i, mode in enumerate(part.modes):
+                if mode != ParamMode.Immediate:
+                    addr = part.params[i] + (ptroffset if mode == ParamMode.Relative else 0)
+                    (self.writes if i == written else self.reads)[addr] += 1
+            if part.opcode == Opcode.ChangePtrOffset:
+                mode, param = part.modes[0], part.params[0]
+                if mode == ParamMode.Immediate:
+                    ptroffset += param
+                else:
+                    ptroffset += vm.data[param + (ptroffset if mode == ParamMode.Relative else 0)]
+
+    def report(self) -> dict:
+        instructions = self.instructions
+        return {
+            "instructions": instructions,
+            "dispatches": self.dispatches,
+            "elapsed": self.elapsed,
+            "blocked": self.blocked,
+            "ips": instructions / self.elapsed if self.elapsed else 0.0,
+            "opcodes": {x.name: n for x, n in self.opcodes.most_common()},
+            "addresses": dict(sorted(self.hits.items())),
+            "memory_reads": sum(self.reads.values()),
+            "memory_writes": sum(self.writes.values()),
+            "reads": dict(sorted(self.reads.items())),
+            "writes": dict(sorted(self.writes.items())),
+        }
+
+    def annotate(self, top: int = None) -> str:
+        """
+        Disassembly of every executed address with its hit count, or only of the top hottest ones.
+        """
+        addrs = sorted(self.hits) if top is None else sorted(x for x, _ in self.hits.most_common(top))
+        total = self.instructions or 1
+        lines = [f"{'hits':>10} {'%':>6} {'addr':>6}  instruction"]
+        last = None
+        for addr in addrs:
+            if last is not None and addr != last:
+                lines.append(f"{'':>10} {'':>6} {'...':>6}")
+            hits = self.hits[addr]
+            lines.append(f"{hits:10d} {100 * hits / total:6.2f} {addr:6d}  {self.instrs[addr]}")
+            last = addr + self.instrs[addr].size
+        return "\n".join(lines)
+
+
+class ProfiledIntcoder:
+    """
+    Counting run loop, mixed in front of the profiled VM's own class while a Profiler is attached.
+    """
+    profiler: Profiler
+
+    def execute(self, stop_on: StopOn, max_steps: Optional[int], max_outputs: Optional[int]) -> ReturnVal:
+        profiler = self.profiler
+        start = time.perf_counter()
+        if profiler.waiting is not None:
+            profiler.blocked += start - profiler.waiting
+            profiler.waiting = None
+        try:
+            limits = RunLimits(self, stop_on, max_steps, max_outputs)
+            stopped = limits.start()
+            if stopped:
+                return stopped
+            for _ in limits.steps:
+                instr = self.peek_instr()
+                if instr.opcode == Opcode.Input and limits.input_blocked():
+                    profiler.waiting = time.perf_counter()
+                    return ReturnVal(RunResult.NeedInput, 0)
+
+                profiler.count(self, instr)
+                self.ptr += instr.size
+                rs = instr.handler(self, instr)
+                if rs is not None:
+                    return ReturnVal(RunResult.Halted, rs)
+
+                if instr.opcode == Opcode.Output:
+                    stopped = limits.output()
+                    if stopped:
+                        return stopped
+            return ReturnVal(RunResult.OutOfSteps, 0)
+        finally:
+            profiler.elapsed += time.perf_counter() - start
+
+    def readbuffer(self):
+        # pulling from an input source counts as blocked, not as running
+        start = time.perf_counter()
+        try:
+            return super().readbuffer()
+        finally:
+            spent = time.perf_counter() - start
+            self.profiler.blocked += spent
+            self.profiler.elapsed -= spent
+
+
+PROFILED_ENGINES: Dict[Type[Intcoder], Type[Intcoder]] = {}
+
+
+def profiled(engine: Type[Intcoder]) -> Type[Intcoder]:
+    if engine not in PROFILED_ENGINES:
+        PROFILED_ENGINES[engine] = type(f"Profiled{engine.__name__}", (ProfiledIntcoder, engine), {})
+    return PROFILED_ENGINES[engine]
+
+
+def main(args: List[str]):
+    # python -m lib.intprofile day9.csv 2
+    vm = Intcoder(load_program(args[0]), [int(x) for x in args[1:]])
+    with Profiler(vm) as profile:
+        result = vm.run()
+    report = profile.report()
+    print(profile.annotate(top=40))
+    print(f"Result {result}: {report['instructions']} instructions, {report['ips']:.0f} per second, "
+          f"{report['memory_reads']} reads, {report['memory_writes']} writes")
+
+
+def test():
+    # day 9 quine: every opcode counted, hot addresses and memory traffic attributed
+    code = [109, 1, 204, -1, 1001, 100, 1, 100, 1008, 100, 16, 101, 1006, 101, 0, 99]
+    vm = Intcoder(code)
+    with Profiler(vm) as profile:
+        vm.run()
+    assert vm.outbuffer == code
+    assert type(vm) is Intcoder and not hasattr(vm, "profiler")
+    report = profile.report()
+    assert report["instructions"] == report["dispatches"] == 16 * 5 + 1
+    assert report["opcodes"]["Output"] == 16 and report["addresses"][2] == 16
+    assert report["writes"][100] == 16 and report["reads"][100] == 32
+    assert "Halt[]" in profile.annotate()
+
+    # time waiting for input is kept apart from running time
+    vm = Intcoder([3, 0, 4, 0, 99])
+    with Profiler(vm) as profile:
+        assert vm.run_until_input().result == RunResult.NeedInput
+        time.sleep(0.01)
+        vm.inbuffer.append(5)
+        assert vm.run_until_input().output == 5
+    assert profile.blocked >= 0.01 > profile.elapsed
+    print("Profiler tests passed.")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(sys.argv[1:])
+    else:
+        test()
@@ -0,0 +1,218 @@
+import io
+import os
+import sys
+import time
+from contextlib import redirect_stderr
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait
+from multiprocessing.synchronize import Lock
+from typing import List, Optional, Sequence, Tuple
+
+from lib.intcoder import Intcoder, RunResult, StopOn
+from lib.intsched import Scheduler
+from lib.intsweep import CONTEXT
+
+RING_CAPACITY = 1024
+# spins that only yield the CPU before a waiting side starts sleeping
+SPIN_LIMIT = 1000
+IDLE_SLEEP = 0.0001
+
+# header cells: values read, values written, capacity
+HEAD, TAIL, CAPACITY, SLOTS = 0, 1, 2, 3
+
+yield_cpu = getattr(os, "sched_yield", lambda: time.sleep(0))
+
+
+def pause(spins: int):
+    if spins < SPIN_LIMIT:
+        yield_cpu()
+    else:
+        time.sleep(IDLE_SLEEP)
+
+
+class Ring:
+    """
+    Single-producer single-consumer FIFO of int64 values in shared memory.
+    Only the consumer writes HEAD and only the producer writes TAIL. Both move under a process-shared
+    lock, which orders the slot writes before the index that publishes them on any CPU; waiting
+    for room or values happens outside it.
+    """
+    shm: shared_memory.SharedMemory
+    cells: memoryview
+    capacity: int
+    owner: bool
+    lock: Lock
+
+    def __init__(self, capacity: int = RING_CAPACITY, name: str = None, lock: Lock = None):
+        self.owner = name is None
+        self.lock = lock or CONTEXT.Lock()
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=(SLOTS + capacity) * 8)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.cells = self.shm.buf.cast("q")
+        if self.owner:
+            self.cells[HEAD] = self.cells[TAIL] = 0
+            self.cells[CAPACITY] = capacity
+        self.capacity = self.cells[CAPACITY]
+
+    def __getstate__(self):
+        # processes that are not forked attach by name
+        return self.shm.name, self.lock
+
+    def __setstate__(self, state: Tuple[str, Lock]):
+        name, lock = state
+        self.__init__(name=name, lock=lock)
+
+    def __len__(self):
+        return self.cells[TAIL] - self.cells[HEAD]
+
+    def put(self, value: int):
+        cells, tail = self.cells, self.cells[TAIL]
+        spins = 0
+        while tail - cells[HEAD] >= self.capacity:
+            pause(spins)
+            spins += 1
+        with self.lock:
+            cells[SLOTS + tail % self.capacity] = value
+            cells[TAIL] = tail + 1
+
+    def get(self) -> Optional[int]:
+        """
+        Next value, or None when the ring is empty.
+        """
+        cells = self.cells
+        with self.lock:
+            head = cells[HEAD]
+            if head == cells[TAIL]:
+                return None
+            value = cells[SLOTS + head % self.capacity]
+            cells[HEAD] = head + 1
+        return value
+
+    def wait(self):
+        spins = 0
+        while not len(self):
+            pause(spins)
+            spins += 1
+
+    def close(self):
+        self.cells.release()
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def run_stage(vm: Intcoder, inbox: Ring, outbox: Ring):
+    vm.inbuffer = inbox.get
+    vm.sink = outbox.put
+    while vm.run(stop_on=StopOn.Input).result != RunResult.Halted:
+        inbox.wait()
+
+
+def run_loop(vms: Sequence[Intcoder], seeds: Sequence[Sequence[int]], input_val: int,
+             capacity: int = RING_CAPACITY) -> int:
+    """
+    Run a ring of VMs in one process each, every VM reading from its own ring and writing to the next one's.
+    Each ring starts with its seed values, the first also gets input_val. Returns what the last VM
+    left in the first ring once all of them halted.
+    """
+    # seeds go in before any stage runs, so nothing would ever make room for the rest
+    if any(len(seed) + (i == 0) > capacity for i, seed in enumerate(seeds)):
+        raise ValueError(f"Seeds do not fit in rings of {capacity} values")
+    rings = [Ring(capacity) for _ in vms]
+    processes = []
+    try:
+        for ring, seed in zip(rings, seeds):
+            for x in seed:
+                ring.put(x)
+        rings[0].put(input_val)
+
+        for i, vm in enumerate(vms):
+            process = CONTEXT.Process(target=run_stage, args=(vm, rings[i], rings[(i + 1) % len(vms)]), daemon=True)
+            process.start()
+            processes.append(process)
+        running = {x.sentinel: i for i, x in enumerate(processes)}
+        while running:
+            for sentinel in wait(list(running)):
+                i = running.pop(sentinel)
+                processes[i].join()
+                if processes[i].exitcode:
+                    raise RuntimeError(f"Stage {i} exited with {processes[i].exitcode}")
+        return rings[0].get()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        for ring in rings:
+            ring.close()
+
+
+def relay(rounds: int) -> List[int]:
+    # read a phase, then pass on each value plus one, rounds times
+    code = [3, 50, 3, 51, 1001, 51, 1, 51, 4, 51, 1001, 52, -1, 52, 1005, 52, 2, 99]
+    return code + [0] * (50 - len(code)) + [0, 0, rounds]
+
+
+def run_scheduled(vms: Sequence[Intcoder], seeds: Sequence[Sequence[int]], input_val: int) -> int:
+    # the in-process loop day7.Amploop runs
+    scheduler = Scheduler()
+    channels = [scheduler.channel() for _ in vms]
+    for i, vm in enumerate(vms):
+        for x in seeds[i]:
+            channels[i].put(x)
+        scheduler.add(vm, channels[i], [channels[(i + 1) % len(vms)]])
+    channels[0].put(input_val)
+    scheduler.run()
+    return channels[0].get()
+
+
+def main(args: List[str]):
+    # python -m lib.intring [rounds]
+    rounds = int(args[0]) if args else 20000
+    amps = 5
+    for name, runner in (("scheduler", run_scheduled), ("processes", run_loop)):
+        vms = [Intcoder(relay(rounds)) for _ in range(amps)]
+        start = time.perf_counter()
+        result = runner(vms, [[x] for x in range(amps)], 0)
+        seconds = time.perf_counter() - start
+        assert result == amps * rounds
+        print(f"{name:>10} {seconds * 1000:8.1f} ms {amps * rounds / seconds:10.0f} values/s")
+    print(f"{os.cpu_count()} cpus")
+
+
+def test():
+    ring = Ring(4)
+    assert ring.get() is None
+    for x in range(4):
+        ring.put(x - 2 ** 62)
+    assert len(ring) == 4 and [ring.get() for _ in range(4)] == [x - 2 ** 62 for x in range(4)]
+    ring.close()
+
+    # rings just big enough for a phase and the value after it
+    vms = [Intcoder(relay(100)) for _ in range(3)]
+    assert run_loop(vms, [[0], [1], [2]], 5, capacity=2) == 305
+    assert run_scheduled([Intcoder(relay(100)) for _ in range(3)], [[0], [1], [2]], 5) == 305
+
+    # a stage that crashes fails the loop while the others still wait on it; its traceback goes to the forked stderr
+    try:
+        with redirect_stderr(io.StringIO()):
+            run_loop([Intcoder(relay(10)), Intcoder([3, 5, 4, 5, 42, 0])], [[0], []], 1)
+        assert False
+    except RuntimeError:
+        pass
+
+    try:
+        run_loop([Intcoder(relay(10))], [[0, 1]], 5, capacity=2)
+        assert False
+    except ValueError:
+        pass
+    print("Ring tests passed.")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(sys.argv[1:])
+    else:
+        test()
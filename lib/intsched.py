@@ -0,0 +1,137 @@
+from collections import deque
+from typing import Deque, List, Optional, Sequence
+
+from lib.intcoder import Intcoder, ReturnVal, RunResult, StopOn
+
+
+class Channel:
+    """
+    FIFO of values between VMs. Any number of VMs and hosts may write to it.
+    VMs blocked reading from it wake up on the next value put.
+    """
+    scheduler: "Scheduler"
+    queue: Deque[int]
+    waiting: List["Task"]
+
+    def __init__(self, scheduler: "Scheduler"):
+        self.scheduler = scheduler
+        self.queue = deque()
+        self.waiting = []
+
+    def __len__(self):
+        return len(self.queue)
+
+    def put(self, value: int):
+        self.queue.append(value)
+        if self.waiting:
+            self.scheduler.ready.extend(self.waiting)
+            self.waiting.clear()
+
+    def get(self) -> int:
+        return self.queue.popleft()
+
+
+class Task:
+    vm: Intcoder
+    inbox: Optional[Channel]
+    outboxes: List[Channel]
+    result: Optional[ReturnVal]
+
+    def __init__(self, vm: Intcoder, inbox: Optional[Channel], outboxes: Sequence[Channel]):
+        self.vm = vm
+        self.inbox = inbox
+        self.outboxes = list(outboxes)
+        self.result = None
+        if inbox is not None:
+            vm.inbuffer = inbox.queue
+        if len(self.outboxes) == 1:
+            vm.sink = self.outboxes[0].put
+        elif self.outboxes:
+            vm.sink = self.broadcast
+
+    def broadcast(self, value: int):
+        for channel in self.outboxes:
+            channel.put(value)
+
+    @property
+    def halted(self) -> bool:
+        return self.result is not None and self.result.result == RunResult.Halted
+
+
+class Scheduler:
+    """
+    Runs a graph of VMs connected by channels. Only VMs that can make progress are run:
+    a VM that needs input waits on its inbox until something is put there.
+    A VM reads from one channel, fan-in is several VMs writing to it. Fan-out writes every output
+    to each of a VM's outboxes; a VM without outboxes keeps its output in outbuffer.
+    """
+    tasks: List[Task]
+    ready: Deque[Task]
+
+    def __init__(self):
+        self.tasks = []
+        self.ready = deque()
+
+    def channel(self) -> Channel:
+        return Channel(self)
+
+    def add(self, vm: Intcoder, inbox: Channel = None, outboxes: Sequence[Channel] = ()) -> Task:
+        task = Task(vm, inbox, outboxes)
+        self.tasks.append(task)
+        self.ready.append(task)
+        return task
+
+    @property
+    def blocked(self) -> List[Task]:
+        return [x for x in self.tasks if not x.halted]
+
+    def run(self, quantum: int = None) -> RunResult:
+        """
+        Run until every VM halted, or until the ones left all wait for input nobody will send (NeedInput).
+        Hosts can put more input and call run again. A quantum caps how many instructions a VM
+        runs before the next ready one gets its turn.
+        """
+        ready = self.ready
+        while ready:
+            task = ready.popleft()
+            rs = task.result = task.vm.run(stop_on=StopOn.Input, max_steps=quantum)
+            if rs.result == RunResult.OutOfSteps:
+                ready.append(task)
+            elif rs.result == RunResult.NeedInput and task.inbox is not None:
+                task.inbox.waiting.append(task)
+        return RunResult.NeedInput if self.blocked else RunResult.Halted
+
+
+def test():
+    # a ring of VMs that each add one to a counter and pass it on, ten times round
+    code = [3, 20, 1001, 20, 1, 20, 4, 20, 1001, 21, 1, 21, 1008, 21, 10, 22, 1006, 22, 0, 99, 0, 0, 0]
+    scheduler = Scheduler()
+    channels = [scheduler.channel() for _ in range(1000)]
+    for i, channel in enumerate(channels):
+        scheduler.add(Intcoder(code), channel, [channels[(i + 1) % len(channels)]])
+    channels[0].put(0)
+    assert scheduler.run(quantum=50) == RunResult.Halted and channels[0].get() == 10000
+
+    # fan-out to two doublers, fan-in of their results into one collector
+    echo = [3, 9, 4, 9, 1105, 1, 0, 99, 0, 0]
+    doubler = [3, 13, 102, 2, 13, 13, 4, 13, 1105, 1, 0, 99, 0, 0]
+    scheduler = Scheduler()
+    source, left, right, results = (scheduler.channel() for _ in range(4))
+    scheduler.add(Intcoder(echo), source, [left, right])
+    scheduler.add(Intcoder(doubler), left, [results])
+    scheduler.add(Intcoder(doubler), right, [results])
+    collector = scheduler.add(Intcoder(echo), results)
+    for x in range(3):
+        source.put(x)
+
+    # the echo loops never halt, so the graph ends up waiting on input
+    assert scheduler.run() == RunResult.NeedInput and len(scheduler.blocked) == 4
+    assert sorted(collector.vm.outbuffer) == [0, 0, 2, 2, 4, 4]
+    source.put(5)
+    scheduler.run()
+    assert sorted(collector.vm.outbuffer[-2:]) == [10, 10]
+    print("Scheduler tests passed.")
+
+
+if __name__ == "__main__":
+    test()
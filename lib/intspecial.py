@@ -0,0 +1,67 @@
+from typing import Sequence
+
+from lib.intcheckpoint import checkpoint, restore
+from lib.intcoder import Intcoder, RunResult, StopOn
+from lib.intmemo import RunCache
+
+
+class Specializer(RunCache):
+    """
+    Partial evaluation on a known prefix of the inputs: the program runs ahead of time up to the first
+    input it doesn't know. Everything until then only depends on the prefix, so runs with that prefix
+    start from the state it left, which is cached like any other run.
+    A prefix the program halts on leaves nothing to run, its residual is the final state.
+    """
+
+    def resume(self, prefix: Sequence[int], rest: Sequence[int] = ()) -> Intcoder:
+        """
+        A fresh VM at the state the prefix left. Whatever the prefix output is in its outbuffer,
+        and goes to a sink first once one is attached.
+        """
+        vm = self.run(prefix).vm.fork()
+        vm.inbuffer = list(rest)
+        return vm
+
+    def evaluate(self, prefix: Sequence[int], rest: Sequence[int] = ()) -> int:
+        outcome = self.run(prefix)
+        if outcome.result == RunResult.Halted:
+            return outcome.value
+        return self.resume(prefix, rest).run()
+
+    def residual(self, prefix: Sequence[int]) -> bytes:
+        """
+        The specialized program as an intcheckpoint blob: memory, entry point and relative base
+        after the prefix, stored against the original program.
+        """
+        return checkpoint(self.run(prefix).vm, self.template)
+
+
+def test():
+    # a mode flag picks the multiplier through a jump, then every later input is scaled by it
+    code = [3, 30, 1008, 30, 1, 31, 1006, 31, 13, 1101, 0, 2, 32, 3, 33, 2, 32, 33, 34, 4, 34, 1105, 1, 13,
+            0, 0, 0, 0, 0, 0, 0, 0, 3, 0, 0]
+    special = Specializer(code)
+    vm = special.resume([1], [5])
+    assert vm.ptr == 13 and vm.data[32] == 2
+    assert vm.run(stop_on=StopOn.Input).result == RunResult.NeedInput and vm.outbuffer == [10]
+    assert special.resume([0], [5, 6]).run(max_outputs=2).output == 18
+    assert (special.hits, special.misses) == (0, 2)
+    assert special.resume([1], [7]).run(max_outputs=1).output == 14 and special.hits == 1
+
+    # outputs of the prefix reach a sink attached later
+    received = []
+    vm = Specializer([104, 7, 3, 9, 4, 9, 99, 0, 0, 0]).resume([], [8])
+    vm.sink = received.append
+    assert vm.run() == 8 and received == [7, 8] and not vm.outbuffer
+
+    # day 5 style: the flag is the only input, so the residual is the finished run
+    assert Specializer([3, 9, 8, 9, 10, 9, 4, 9, 99, -1, 8]).evaluate([8]) == 1
+
+    # the residual program as a checkpoint of the original
+    vm = restore(special.residual([0]), code)
+    assert vm.ptr == 13 and vm.run([4], max_outputs=1).output == 12
+    print("Specializer tests passed.")
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,391 @@
+"""
+Static analysis and peephole optimization of Intcode images.
+Relative operands are not tracked: the relative base is never followed through the program,
+so optimize() leaves an image that uses them as it is, unless isolated_stack promises they only
+reach cells past the image. Even then stack slots never count as constants, so code that keeps
+its values on the stack, like day 9's recursion, runs the same instructions as before.
+"""
+import sys
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Set
+
+from lib.intcoder import MAX_INSTR_SIZE, MODE_DIVISORS, OPCODES, PARAM_COUNTS, Instruction, Intcoder, Opcode, ParamMode
+from lib.intimage import load_program
+from lib.intprofile import WRITE_OPERANDS, Profiler
+
+MAX_PASSES = 32
+JUMPS = (Opcode.JumpIfTrue, Opcode.JumpIfFalse)
+FOLDABLE = {
+    Opcode.Add: lambda a, b: a + b,
+    Opcode.Mul: lambda a, b: a * b,
+    Opcode.LessThan: lambda a, b: 1 if a < b else 0,
+    Opcode.Equals: lambda a, b: 1 if a == b else 0,
+}
+
+
+def decode(image: Sequence[int], addr: int) -> Optional[Instruction]:
+    def cell(x: int) -> int:
+        return image[x] if x < len(image) else 0
+
+    if addr < 0:
+        return None
+    raw_opcode = cell(addr)
+    if raw_opcode < 0 or raw_opcode % 100 not in OPCODES:
+        return None
+    opcode = Opcode(raw_opcode % 100)
+    num_params = PARAM_COUNTS[opcode]
+    modes = []
+    for x in range(num_params):
+        mode = raw_opcode // MODE_DIVISORS[x] % 10
+        if mode not in (0, 1, 2):
+            return None
+        modes.append(ParamMode(mode))
+    return Instruction(opcode, tuple(cell(addr + x + 1) for x in range(num_params)), tuple(modes))
+
+
+def encode(instr: Instruction) -> List[int]:
+    raw_opcode = int(instr.opcode) + sum(int(mode) * MODE_DIVISORS[x] for x, mode in enumerate(instr.modes))
+    return [raw_opcode, *instr.params]
+
+
+class ControlFlow:
+    """
+    Static view of an Intcode image: code reachable from address 0 through constant jump
+    targets, which cells it reads and writes, and which operands are constant.
+    Code that gets rewritten at run time is assumed to keep its operands and parameter modes
+    and only change its opcode, like the day 5 diagnostic does. A jump to a computed address
+    may land on any address the program stores as a constant.
+    Relative operands can reach any cell, unless isolated_stack promises they stay past the image.
+    """
+    image: List[int]
+    isolated_stack: bool
+    written: Set[int]
+    instrs: Dict[int, Instruction]
+    succs: Dict[int, Set[int]]
+    reads: Set[int]
+    writes: Set[int]
+    writers: Dict[int, Set[int]]
+    prefix: Dict[int, int]
+    wild_reads: bool
+    wild_writes: bool
+    indirect: Set[int]
+    volatile: Set[int]
+
+    def __init__(self, image: Sequence[int], isolated_stack: bool = False):
+        self.image = list(image)
+        self.isolated_stack = isolated_stack
+        self.written = set()
+        self.instrs, self.writers, self.prefix, self.volatile = {}, {}, {}, set()
+        self.wild_writes = False
+        # each pass relies on the writes earlier passes saw, until a pass turns up nothing new
+        for _ in range(MAX_PASSES):
+            writers = self.writers
+            self.explore()
+            if self.wild_writes or self.writes <= self.written and self.writers == writers:
+                break
+            self.written |= self.writes
+        else:
+            self.wild_writes = True
+
+    def cell(self, addr: int) -> int:
+        return self.image[addr] if 0 <= addr < len(self.image) else 0
+
+    def constant(self, instr: Instruction, i: int) -> Optional[int]:
+        mode = instr.modes[i]
+        if mode == ParamMode.Immediate:
+            return instr.params[i]
+        if mode == ParamMode.Positional and instr.params[i] >= 0 and instr.params[i] not in self.written:
+            return self.cell(instr.params[i])
+        return None
+
+    def explore(self):
+        last_instrs, last_writers, last_prefix, last_volatile = self.instrs, self.writers, self.prefix, self.volatile
+        self.instrs, self.succs = {}, {}
+        self.reads, self.writes, self.writers = set(), set(), {}
+        self.wild_reads = self.wild_writes = False
+        self.indirect, self.volatile = set(), set()
+
+        def stored(cell: int) -> Optional[Set[int]]:
+            # every value the previous pass saw written to cell, if they are all constant
+            values = {self.cell(cell)}
+            for writer in last_writers.get(cell, ()):
+                instr = last_instrs[writer]
+                if writer in last_volatile or instr.opcode not in FOLDABLE:
+                    return None
+                a, b = self.constant(instr, 0), self.constant(instr, 1)
+                if a is None or b is None:
+                    return None
+                values.add(FOLDABLE[instr.opcode](a, b))
+            return values
+
+        todo, seen = [0], set()
+        while True:
+            # a jump to a computed address may land on any stored constant that points into the image
+            if not todo and self.indirect:
+                todo.extend(self.address_constants() - seen)
+            if not todo:
+                break
+            addr = todo.pop()
+            if addr in seen or not 0 <= addr < len(self.image):
+                continue
+            seen.add(addr)
+            instr = decode(self.image, addr)
+            if self.overwritten(addr, instr.size if instr else 1, last_writers, last_prefix):
+                instr = self.rewritable(addr, instr)
+            if instr is None:
+                continue
+            self.instrs[addr] = instr
+            if addr not in self.volatile:
+                self.access(addr, instr)
+            self.succs[addr] = self.successors(addr, instr, stored)
+            todo.extend(self.succs[addr])
+        self.prefix = self.entry_prefix()
+
+    def entry_prefix(self) -> Dict[int, int]:
+        # the straight run of code from address 0 that nothing jumps back into executes only once
+        preds: Dict[int, int] = {}
+        for succs in self.succs.values():
+            for x in succs:
+                preds[x] = preds.get(x, 0) + 1
+        prefix = {}
+        addr = 0
+        while addr in self.instrs and addr not in prefix and preds.get(addr, 0) == (1 if prefix else 0):
+            prefix[addr] = len(prefix)
+            if len(self.succs[addr]) != 1:
+                break
+            addr = next(iter(self.succs[addr]))
+        return prefix
+
+    @staticmethod
+    def overwritten(addr: int, size: int, writers: Dict[int, Set[int]], prefix: Dict[int, int]) -> bool:
+        # a write only matters if the instruction can run after it
+        for x in range(addr, addr + size):
+            for writer in writers.get(x, ()):
+                if addr not in prefix or writer in prefix and prefix[writer] < prefix[addr]:
+                    return True
+        return False
+
+    def rewritable(self, addr: int, instr: Optional[Instruction]) -> Instruction:
+        # code written at run time: any opcode may end up here, over the same operand cells
+        self.volatile.add(addr)
+        raw_opcode = self.cell(addr)
+        modes = tuple(ParamMode(x) if x in (0, 1, 2) else ParamMode.Positional
+                      for x in (abs(raw_opcode) // MODE_DIVISORS[i] % 10 for i in range(MAX_INSTR_SIZE - 1)))
+        for opcode in Opcode:
+            num_params = PARAM_COUNTS[opcode]
+            self.access(addr, Instruction(opcode, tuple(self.cell(addr + x + 1) for x in range(num_params)),
+                                          modes[:num_params]))
+        return instr or Instruction(Opcode.Add, tuple(self.cell(addr + x + 1) for x in range(3)), modes)
+
+    def access(self, addr: int, instr: Instruction):
+        written = WRITE_OPERANDS.get(instr.opcode)
+        for i, mode in enumerate(instr.modes):
+            if mode == ParamMode.Immediate:
+                continue
+            if mode == ParamMode.Relative:
+                if not self.isolated_stack:
+                    if i == written:
+                        self.wild_writes = True
+                    else:
+                        self.wild_reads = True
+            elif i == written:
+                self.writes.add(instr.params[i])
+                self.writers.setdefault(instr.params[i], set()).add(addr)
+            else:
+                self.reads.add(instr.params[i])
+
+    def successors(self, addr: int, instr: Instruction, stored: Callable[[int], Optional[Set[int]]]) -> Set[int]:
+        fallthrough = addr + instr.size
+        if addr in self.volatile:
+            # it may halt, fall through past any number of operands or jump to its second operand
+            targets = {addr + x for x in range(2, MAX_INSTR_SIZE + 1)}
+            target = self.cell(addr + 2)
+            targets.update((target, self.cell(target)))
+            return targets
+        if instr.opcode == Opcode.Halt:
+            return set()
+        if instr.opcode not in JUMPS:
+            return {fallthrough}
+
+        taken = self.taken(instr)
+        targets = set()
+        if taken is not True:
+            targets.add(fallthrough)
+        if taken is not False:
+            target = self.constant(instr, 1)
+            values = stored(instr.params[1]) if target is None and instr.modes[1] == ParamMode.Positional else None
+            if target is not None:
+                targets.add(target)
+            elif values is not None:
+                targets.update(values)
+            else:
+                self.indirect.add(addr)
+        return targets
+
+    def taken(self, instr: Instruction) -> Optional[bool]:
+        cond = self.constant(instr, 0)
+        if cond is None:
+            return None
+        return (cond != 0) == (instr.opcode == Opcode.JumpIfTrue)
+
+    def address_constants(self) -> Set[int]:
+        # constants the program stores, such as return addresses pushed before a call
+        values = set()
+        for addr, instr in self.instrs.items():
+            if instr.opcode in FOLDABLE and addr not in self.volatile:
+                values.update(instr.params[i] for i in range(2) if instr.modes[i] == ParamMode.Immediate)
+        return {x for x in values if 0 <= x < len(self.image)}
+
+    @property
+    def closed(self) -> bool:
+        return not self.indirect
+
+    def code_cells(self) -> Set[int]:
+        return {x for addr, instr in self.instrs.items() for x in range(addr, addr + instr.size)}
+
+    def targets(self) -> Set[int]:
+        return {x for addr, succs in self.succs.items() for x in succs if x != addr + self.instrs[addr].size}
+
+    def disassemble(self) -> str:
+        """
+        Listing of the image: reachable code with jump targets labelled, everything else as data.
+        """
+        labels = self.targets()
+        lines = []
+        addr = 0
+        while addr < len(self.image):
+            instr = self.instrs.get(addr)
+            label = ">" if addr in labels else " "
+            if instr:
+                notes = " (rewritten at run time)" if addr in self.volatile else ""
+                lines.append(f"{label}{addr:6d}  {instr}{notes}")
+                addr += instr.size
+            else:
+                lines.append(f"{label}{addr:6d}  .data {self.image[addr]}")
+                addr += 1
+        return "\n".join(lines)
+
+
+def optimize(image: Sequence[int], isolated_stack: bool = False) -> List[int]:
+    """
+    Rewrite an image in place so it dispatches fewer or cheaper instructions with the same I/O:
+    constant operands become immediate, constant results and conditions are folded, jumps are
+    threaded past no-ops and other jumps, and unreachable code is cleared.
+    Nothing moves, so data and computed jumps keep working.
+    """
+    cfg = ControlFlow(image, isolated_stack)
+    out = list(image)
+    if cfg.wild_reads or cfg.wild_writes:
+        return out
+
+    owners: Dict[int, int] = {}
+    for addr, instr in cfg.instrs.items():
+        for x in range(addr, addr + instr.size):
+            owners[x] = owners.get(x, 0) + 1
+
+    def fixed(addr: int) -> bool:
+        instr = cfg.instrs.get(addr)
+        return (instr is not None and addr not in cfg.volatile
+                and all(owners[x] == 1 and x not in cfg.reads for x in range(addr, addr + instr.size)))
+
+    def noop(addr: int) -> bool:
+        instr = cfg.instrs[addr]
+        if instr.opcode not in JUMPS or addr in cfg.volatile:
+            return False
+        taken = cfg.taken(instr)
+        return taken is False or (taken is True and cfg.constant(instr, 1) == addr + instr.size)
+
+    def resolve(target: int) -> int:
+        # follow no-ops and unconditional jumps to where execution really continues
+        seen = set()
+        while target in cfg.instrs and target not in cfg.volatile and target not in seen:
+            seen.add(target)
+            instr = cfg.instrs[target]
+            if noop(target):
+                target += instr.size
+            elif instr.opcode in JUMPS and cfg.taken(instr) is True and cfg.constant(instr, 1) is not None:
+                target = cfg.constant(instr, 1)
+            else:
+                break
+        return target
+
+    for addr, instr in cfg.instrs.items():
+        if not fixed(addr):
+            continue
+        params, modes = list(instr.params), list(instr.modes)
+        opcode = instr.opcode
+        for i, mode in enumerate(modes):
+            value = cfg.constant(instr, i)
+            if mode == ParamMode.Positional and i != WRITE_OPERANDS.get(opcode) and value is not None:
+                params[i], modes[i] = value, ParamMode.Immediate
+
+        if opcode in FOLDABLE and modes[0] == modes[1] == ParamMode.Immediate:
+            params[:2] = FOLDABLE[opcode](params[0], params[1]), 0
+            opcode = Opcode.Add
+        elif opcode in JUMPS:
+            taken = cfg.taken(instr)
+            if noop(addr):
+                # runs of no-ops and jumps collapse into a single jump
+                end = resolve(addr)
+                if end != addr + instr.size:
+                    opcode, params, modes = Opcode.JumpIfTrue, [1, end], [ParamMode.Immediate] * 2
+            elif modes[1] == ParamMode.Immediate:
+                params[1] = resolve(params[1])
+                if taken is True:
+                    opcode, params[0] = Opcode.JumpIfTrue, 1
+        rewritten = Instruction(opcode, tuple(params), tuple(modes))
+        out[addr:addr + instr.size] = encode(rewritten)
+
+    if cfg.closed:
+        code = cfg.code_cells()
+        for x in range(len(out)):
+            if x not in code and x not in cfg.reads and x not in cfg.writes:
+                out[x] = 0
+    return out
+
+
+def dispatches(image: Iterable[int], inputs: List[int] = None) -> int:
+    vm = Intcoder(list(image), inputs)
+    with Profiler(vm) as profile:
+        vm.run()
+    return profile.instructions
+
+
+def test():
+    # jump chains are threaded, constant conditions folded and dead code cleared
+    code = [1105, 1, 5, 99, 99, 1106, 0, 9, 99, 104, 7, 1006, 20, 17, 104, 8, 99, 99, 0, 0, 0]
+    cfg = ControlFlow(code)
+    assert cfg.closed and sorted(cfg.instrs) == [0, 5, 9, 11, 17]
+    optimized = optimize(code)
+    assert optimized[:3] == [1105, 1, 9] and optimized[11:14] == [1105, 1, 17]
+    assert optimized[3:5] == [0, 0] and optimized[20] == 0
+    assert dispatches(optimized) == 4 < dispatches(code) == 5
+
+    # constant operands turn immediate, but cells the program writes or reads as data stay put
+    code = [1, 13, 14, 15, 4, 15, 1, 13, 15, 15, 4, 0, 99, 2, 3, 0]
+    optimized = optimize(code)
+    assert optimized[:6] == code[:6] and optimized[6:10] == [101, 2, 15, 15]
+    assert Intcoder(optimized).run() == Intcoder(code).run()
+
+    # the day 5 trick: an input added to an opcode decides where the program goes
+    code = [3, 11, 1, 11, 6, 6, 1100, 1, 13, 12, 99, 0, 0, 104, 1, 99]
+    cfg = ControlFlow(code)
+    assert 6 in cfg.volatile and {10, 13} <= set(cfg.instrs)
+    assert "(rewritten at run time)" in cfg.disassemble()
+    assert optimize(code)[6:10] == code[6:10]
+    for x in (1, 5):
+        assert Intcoder(optimize(code), [x]).run() == Intcoder(code, [x]).run()
+
+    # relative operands leave the image alone, unless the stack is known to be past it
+    code = [109, 20, 21101, 3, 4, 0, 1005, 13, 11, 99, 0, 204, 0, 99]
+    assert optimize(code) == code
+    optimized = optimize(code, isolated_stack=True)
+    assert optimized[6:9] == [1105, 1, 11] and Intcoder(optimized).run() == Intcoder(code).run() == 7
+    print("Static analysis tests passed.")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        # python -m lib.intstatic day5.csv
+        print(ControlFlow(load_program(sys.argv[1])).disassemble())
+    else:
+        test()
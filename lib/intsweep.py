@@ -0,0 +1,159 @@
+import os
+from array import array
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from itertools import islice
+from multiprocessing import get_all_start_methods, get_context, shared_memory
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Type
+
+from lib.intcoder import Intcoder, Snapshot
+
+# forked workers inherit the parent's modules instead of re-running the day scripts on import
+CONTEXT = get_context("fork") if "fork" in get_all_start_methods() else get_context()
+
+
+class SweepJob(NamedTuple):
+    patches: Dict[int, int]
+    inputs: List[int]
+
+
+class SweepResult(NamedTuple):
+    index: int
+    job: Any
+    value: Any
+
+
+Task = Callable[[Snapshot, Any], Any]
+
+
+def run_job(snapshot: Snapshot, job: SweepJob) -> Tuple[int, List[int]]:
+    vm = snapshot.fork()
+    for addr, val in job.patches.items():
+        vm.putaddr(addr, val)
+    vm.inbuffer = job.inputs
+    return vm.run(), vm.outbuffer
+
+
+worker_snapshot: Optional[Snapshot] = None
+worker_task: Optional[Task] = None
+
+
+def init_worker(shm_name: Optional[str], size: int, image: Optional[List[int]], engine: Type[Intcoder], task: Task):
+    global worker_snapshot, worker_task
+    if shm_name:
+        shm = shared_memory.SharedMemory(name=shm_name)
+        try:
+            cells = array("q")
+            cells.frombytes(shm.buf[:size * cells.itemsize])
+            image = cells.tolist()
+        finally:
+            shm.close()
+    worker_snapshot = engine(image).snapshot()
+    worker_task = task
+
+
+def run_chunk(chunk: List[Tuple[int, Any]]) -> List[SweepResult]:
+    return [SweepResult(index, job, worker_task(worker_snapshot, job)) for index, job in chunk]
+
+
+def sweep(program: Sequence[int], jobs: Iterable[Any], task: Task = run_job, engine: Type[Intcoder] = Intcoder,
+          workers: int = None, chunksize: int = 64, ordered: bool = True,
+          until: Callable[[SweepResult], bool] = None) -> Iterator[SweepResult]:
+    """
+    Run task(snapshot, job) for every job on a pool of worker processes.
+    Workers read the program from shared memory once and fork each run from a snapshot.
+    Results stream back in job order, or as they complete if ordered is False.
+    Stopping early (until, or closing the iterator) cancels the work not yet started.
+    workers=0 runs every job in this process, where a profiler can see it.
+    """
+    if workers == 0:
+        yield from sweep_here(program, jobs, task, engine, until)
+        return
+    workers = workers or os.cpu_count() or 1
+    shm = None
+    try:
+        cells = array("q", program)
+        shm = shared_memory.SharedMemory(create=True, size=max(len(cells) * cells.itemsize, 1))
+        shm.buf[:len(cells) * cells.itemsize] = cells.tobytes()
+        initargs = (shm.name, len(cells), None, engine, task)
+    except OverflowError:
+        # cells past 64 bits can't go through the int64 buffer, send the image once per worker instead
+        initargs = (None, len(program), list(program), engine, task)
+
+    numbered = enumerate(jobs)
+    executor = ProcessPoolExecutor(workers, mp_context=CONTEXT, initializer=init_worker, initargs=initargs)
+    try:
+        pending: Dict[Future, int] = {}
+        finished: Dict[int, List[SweepResult]] = {}
+        submitted = 0
+        next_chunk = 0
+
+        def refill():
+            nonlocal submitted
+            while len(pending) < workers * 2:
+                chunk = list(islice(numbered, chunksize))
+                if not chunk:
+                    return
+                pending[executor.submit(run_chunk, chunk)] = submitted
+                submitted += 1
+
+        refill()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                finished[pending.pop(future)] = future.result()
+
+            if ordered:
+                ready = []
+                while next_chunk in finished:
+                    ready.append(finished.pop(next_chunk))
+                    next_chunk += 1
+            else:
+                ready = list(finished.values())
+                finished.clear()
+
+            for results in ready:
+                for result in results:
+                    yield result
+                    if until and until(result):
+                        return
+            refill()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        if shm:
+            shm.close()
+            shm.unlink()
+
+
+def sweep_here(program: Sequence[int], jobs: Iterable[Any], task: Task, engine: Type[Intcoder],
+               until: Optional[Callable[[SweepResult], bool]]) -> Iterator[SweepResult]:
+    snapshot = engine(list(program)).snapshot()
+    for index, job in enumerate(jobs):
+        result = SweepResult(index, job, task(snapshot, job))
+        yield result
+        if until and until(result):
+            return
+
+
+def test():
+    # day 5 comparison program: one job per input, results stay in job order
+    code = [3, 9, 8, 9, 10, 9, 4, 9, 99, -1, 8]
+    jobs = [SweepJob({}, [x]) for x in range(20)]
+    results = list(sweep(code, jobs, workers=2, chunksize=3))
+    assert [x.index for x in results] == list(range(20))
+    assert [x.value[0] for x in results] == [1 if x == 8 else 0 for x in range(20)]
+    assert list(sweep(code, jobs, workers=0)) == results
+
+    # patches, unordered results and early cancellation on an endless job stream
+    def endless():
+        x = 0
+        while True:
+            yield SweepJob({1: x}, [])
+            x += 1
+    code = [1101, 0, 5, 0, 99]
+    results = list(sweep(code, endless(), workers=2, ordered=False, until=lambda x: x.value[0] == 42))
+    assert results[-1].job.patches[1] == 37
+    print("Sweep tests passed.")
+
+
+if __name__ == "__main__":
+    test()
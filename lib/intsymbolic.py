@@ -0,0 +1,266 @@
+from itertools import product
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from lib.intcoder import HANDLERS, Instruction, Intcoder, Opcode, ParamMode
+
+
+class Affine:
+    """
+    const + sum(coeff * symbol), the value of a cell as a function of the symbols.
+    """
+    __slots__ = ("const", "terms")
+
+    const: int
+    terms: Tuple[Tuple[str, int], ...]
+
+    def __init__(self, const: int = 0, terms: Sequence[Tuple[str, int]] = ()):
+        self.const = const
+        self.terms = tuple(sorted((name, coeff) for name, coeff in terms if coeff))
+
+    @staticmethod
+    def symbol(name: str) -> "Affine":
+        return Affine(0, [(name, 1)])
+
+    @property
+    def symbolic(self) -> bool:
+        return bool(self.terms)
+
+    def __add__(self, other: "Affine") -> "Affine":
+        coeffs = dict(self.terms)
+        for name, coeff in other.terms:
+            coeffs[name] = coeffs.get(name, 0) + coeff
+        return Affine(self.const + other.const, coeffs.items())
+
+    def scale(self, factor: int) -> "Affine":
+        return Affine(self.const * factor, [(name, coeff * factor) for name, coeff in self.terms])
+
+    def evaluate(self, values: Dict[str, int]) -> int:
+        return self.const + sum(coeff * values[name] for name, coeff in self.terms)
+
+    def __eq__(self, other):
+        return isinstance(other, Affine) and (self.const, self.terms) == (other.const, other.terms)
+
+    def __hash__(self):
+        return hash((self.const, self.terms))
+
+    def __repr__(self):
+        parts = [name if coeff == 1 else f"{coeff}*{name}" for name, coeff in self.terms]
+        if self.const or not parts:
+            parts.append(str(self.const))
+        return " + ".join(parts)
+
+
+# a value that depends on the symbols, but not affinely
+Shadow = Optional[Affine]
+
+
+class SymbolicIntcoder(Intcoder):
+    """
+    Runs concretely on sample values while tracking each cell that depends on the symbols as an affine
+    expression over them. Values that stop being affine (a product of two symbolic values, a comparison,
+    a read through a symbolic address) become None. Branches and addresses stay concrete: once one of
+    them depends on the symbols, path_dependent is set and the formulas only hold for inputs that take
+    the same path as the samples.
+    """
+    exprs: Dict[int, Shadow]
+    offset_expr: Shadow
+    input_symbols: Dict[int, str]
+    inputs_read: int
+    pending_input: Shadow
+    outexprs: List[Shadow]
+    path_dependent: bool
+
+    def __init__(self, data, input_buffer=None, symbols: Dict[int, str] = None, input_symbols: Dict[int, str] = None):
+        super().__init__(data, input_buffer)
+        self.exprs = {addr: Affine.symbol(name) for addr, name in (symbols or {}).items()}
+        self.offset_expr = Affine()
+        self.input_symbols = dict(input_symbols or {})
+        self.inputs_read = 0
+        self.pending_input = None
+        self.outexprs = []
+        self.path_dependent = False
+
+    def fork(self) -> "SymbolicIntcoder":
+        child = super().fork()
+        child.exprs = dict(self.exprs)
+        child.input_symbols = dict(self.input_symbols)
+        child.outexprs = list(self.outexprs)
+        return child
+
+    def decode(self, addr: int) -> Instruction:
+        instr = super().decode(addr)
+        if addr in self.exprs:
+            self.path_dependent = True
+        instr.handler = SYMBOLIC_HANDLERS[instr.opcode]
+        return instr
+
+    def cell(self, addr: int) -> Shadow:
+        return self.exprs[addr] if addr in self.exprs else Affine(self.data[addr])
+
+    def address_symbolic(self, instr: Instruction, start: int, i: int) -> bool:
+        if start + 1 + i in self.exprs:
+            return True
+        return instr.modes[i] == ParamMode.Relative and (self.offset_expr is None or self.offset_expr.symbolic)
+
+    def shadow(self, instr: Instruction, start: int, i: int) -> Shadow:
+        if instr.modes[i] == ParamMode.Immediate:
+            return self.cell(start + 1 + i)
+        if self.address_symbolic(instr, start, i):
+            return None
+        return self.cell(self.addr(instr, i))
+
+    def store_shadow(self, instr: Instruction, start: int, i: int, value: Shadow):
+        if self.address_symbolic(instr, start, i):
+            # the concrete run writes where the samples point, other inputs write elsewhere
+            self.path_dependent = True
+        addr = self.addr(instr, i)
+        if value is not None and not value.symbolic:
+            self.exprs.pop(addr, None)
+        else:
+            self.exprs[addr] = value
+
+    def concrete(self, value: Shadow):
+        if value is None or value.symbolic:
+            self.path_dependent = True
+
+    def formula(self) -> Shadow:
+        """
+        The halt value, the last output or cell 0, as a function of the symbols.
+        """
+        if self.outexprs:
+            return self.outexprs[-1]
+        return self.cell(0)
+
+    def readbuffer(self):
+        name = self.input_symbols.get(self.inputs_read)
+        self.inputs_read += 1
+        value = super().readbuffer()
+        self.pending_input = Affine.symbol(name) if name is not None else Affine(value)
+        return value
+
+
+def shadow_arithmetic(vm: SymbolicIntcoder, instr: Instruction, start: int):
+    a, b = vm.shadow(instr, start, 0), vm.shadow(instr, start, 1)
+    if a is None or b is None:
+        value = None
+    elif instr.opcode == Opcode.Add:
+        value = a + b
+    elif instr.opcode == Opcode.Mul and not (a.symbolic and b.symbolic):
+        value = a.scale(b.const) if a.symbolic else b.scale(a.const)
+    else:
+        value = None
+    vm.store_shadow(instr, start, 2, value)
+
+
+def symbolic_step(vm: SymbolicIntcoder, instr: Instruction) -> Optional[int]:
+    start = vm.ptr - instr.size
+    opcode = instr.opcode
+    if opcode in (Opcode.Add, Opcode.Mul):
+        shadow_arithmetic(vm, instr, start)
+    elif opcode in (Opcode.LessThan, Opcode.Equals):
+        a, b = vm.shadow(instr, start, 0), vm.shadow(instr, start, 1)
+        rs = HANDLERS[opcode](vm, instr)
+        symbolic = a is None or b is None or a.symbolic or b.symbolic
+        vm.store_shadow(instr, start, 2, None if symbolic else Affine(vm.data[vm.addr(instr, 2)]))
+        return rs
+    elif opcode in (Opcode.JumpIfTrue, Opcode.JumpIfFalse):
+        vm.concrete(vm.shadow(instr, start, 0))
+        vm.concrete(vm.shadow(instr, start, 1))
+    elif opcode == Opcode.ChangePtrOffset:
+        delta = vm.shadow(instr, start, 0)
+        vm.offset_expr = None if delta is None or vm.offset_expr is None else vm.offset_expr + delta
+    elif opcode == Opcode.Output:
+        vm.outexprs.append(vm.shadow(instr, start, 0))
+    elif opcode == Opcode.Input:
+        rs = HANDLERS[opcode](vm, instr)
+        vm.store_shadow(instr, start, 0, vm.pending_input)
+        return rs
+    return HANDLERS[opcode](vm, instr)
+
+
+SYMBOLIC_HANDLERS = {x: symbolic_step for x in HANDLERS}
+
+
+def solve(formula: Affine, target: int, bounds: Dict[str, range]) -> Iterator[Dict[str, int]]:
+    """
+    Every assignment of the symbols within bounds for which formula equals target.
+    All symbols but the one with the widest range are enumerated, that one is solved for.
+    """
+    coeffs = dict(formula.terms)
+    free = [x for x in bounds if x not in coeffs]
+    if not coeffs:
+        if formula.const == target:
+            yield from (dict(zip(bounds, values)) for values in product(*bounds.values()))
+        return
+    last = max(coeffs, key=lambda x: len(bounds[x]))
+    others = [x for x in coeffs if x != last]
+    for values in product(*(bounds[x] for x in others)):
+        assignment = dict(zip(others, values))
+        rest = target - formula.const - sum(coeffs[x] * assignment[x] for x in others)
+        if rest % coeffs[last] == 0 and rest // coeffs[last] in bounds[last]:
+            assignment[last] = rest // coeffs[last]
+            for free_values in product(*(bounds[x] for x in free)):
+                yield {**assignment, **dict(zip(free, free_values))}
+
+
+def run_patched(program: Sequence[int], cells: Dict[int, str], assignment: Dict[str, int]) -> int:
+    vm = Intcoder(program)
+    for addr, name in cells.items():
+        vm.putaddr(addr, assignment[name])
+    return vm.run()
+
+
+def find_patches(program: Sequence[int], cells: Dict[int, str], bounds: Dict[str, range],
+                 target: int) -> Optional[Dict[str, int]]:
+    """
+    Values for the symbolic cells within bounds that make the program return target.
+    One symbolic run gives the result as a formula to solve, candidates are confirmed by a concrete run.
+    When the result is not affine, every combination is run concretely instead.
+    """
+    sample = {name: bounds[name][0] for name in bounds}
+    vm = SymbolicIntcoder(program, symbols=cells)
+    for addr, name in cells.items():
+        vm.data[addr] = sample[name]
+    vm.run()
+    formula = vm.formula()
+
+    if formula is not None:
+        for assignment in solve(formula, target, bounds):
+            if not vm.path_dependent or run_patched(program, cells, assignment) == target:
+                return assignment
+        if not vm.path_dependent:
+            return None
+
+    for values in product(*bounds.values()):
+        assignment = dict(zip(bounds, values))
+        if run_patched(program, cells, assignment) == target:
+            return assignment
+    return None
+
+
+def test():
+    # cell 0 = 3 * a + b + 7, with a and b patched into cells 13 and 14
+    code = [1002, 13, 3, 15, 1, 15, 14, 0, 1001, 0, 7, 0, 99, 0, 0, 0]
+    vm = SymbolicIntcoder(code, symbols={13: "a", 14: "b"})
+    vm.run()
+    assert repr(vm.formula()) == "3*a + b + 7" and not vm.path_dependent
+    assert find_patches(code, {13: "a", 14: "b"}, {"a": range(10), "b": range(10)}, 30) == {"a": 7, "b": 2}
+    assert find_patches(code, {13: "a", 14: "b"}, {"a": range(3), "b": range(3)}, 30) is None
+
+    # a product of two symbols is not affine, the search falls back to concrete runs
+    square = [2, 7, 8, 0, 99, 0, 0, 0, 0]
+    vm = SymbolicIntcoder(square, symbols={7: "a", 8: "b"})
+    vm.run()
+    assert vm.formula() is None
+    assert find_patches(square, {7: "a", 8: "b"}, {"a": range(1, 10), "b": range(1, 10)}, 42) == {"a": 6, "b": 7}
+
+    # symbolic input that decides a branch: the formula is checked against a concrete run
+    branch = [3, 20, 1008, 20, 5, 21, 1005, 21, 12, 4, 20, 99, 104, 0, 99] + [0] * 7
+    vm = SymbolicIntcoder(branch, [1], input_symbols={0: "x"})
+    vm.run()
+    assert repr(vm.formula()) == "x" and vm.path_dependent
+    print("Symbolic execution tests passed.")
+
+
+if __name__ == "__main__":
+    test()